@@ -0,0 +1,237 @@
+# --------------------------------------------------------
+# Per-block cost report of a models_mae_distill.MaskedAutoencoderViT training forward
+#
+# Forward hooks on the patch embed, every encoder / decoder block, the norms, the
+# decoder embed / prediction layers and the feature projection heads record, for one
+# model factory and mask ratio: forward FLOPs, measured latency (with autograd
+# recording, as in training), parameter count and the bytes of the activations
+# autograd saves for backward. Helps choosing --aligned_blks_indices, decoder depth
+# or which blocks to checkpoint. Usage (from the repository root):
+#   python -m benchmarks.analyze_blocks --model mae_vit_tiny_patch16_dec512d2b --output_json tiny.json
+#   python -m benchmarks.analyze_blocks --model mae_vit_small_patch16_dec512d8b --mask_ratio 0.9 \
+#       --aligned_blks_indices 5 8 --aligned_feature_projection_mode fc-1layer
+# --------------------------------------------------------
+
+import argparse
+import json
+import time
+from collections import OrderedDict, defaultdict
+
+import torch
+import torch.nn as nn
+
+import models.models_mae_distill as models_mae_distill
+from benchmarks.bench_models import encoder_of
+from util.profiler import transformer_block_flops
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MaskedAutoencoderViT per-block analyzer', add_help=False)
+    parser.add_argument('--model', default='mae_vit_tiny_patch16_dec512d2b', type=str)
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--mask_ratio', default=0.75, type=float)
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--aligned_blks_indices', nargs='+', type=int, default=None,
+                        help='student blocks aligned in distillation (default: plain MAE forward)')
+    parser.add_argument('--aligned_feature_projection_mode', default=None, type=str,
+                        choices=['fc-1layer', 'mlp-1layer', 'mlp-2layer'])
+    parser.add_argument('--teacher_dim', default=768, type=int,
+                        help='teacher feature dim the projection heads map to')
+    parser.add_argument('--warmup', default=2, type=int, help='untimed forwards')
+    parser.add_argument('--repeats', default=5, type=int, help='timed forwards')
+    parser.add_argument('--cpu_threads', default=0, type=int, help='torch threads (0: torch default)')
+    parser.add_argument('--output_json', default=None, type=str, help='where to write the results')
+    return parser
+
+
+def linear_flops(module, num_rows):
+    """FLOPs of all the nn.Linear layers of module applied to num_rows rows."""
+    return sum(2 * num_rows * m.in_features * m.out_features for m in module.modules() if isinstance(m, nn.Linear))
+
+
+def unit_flops(kind, module, x):
+    """Forward FLOPs of one unit for its input x; norms are not counted."""
+    if kind == 'patch_embed':
+        weight = module.proj.weight
+        return 2 * x.shape[0] * module.num_patches * weight[0].numel() * weight.shape[0]
+    if kind in ('block', 'decoder_block'):
+        return x.shape[0] * transformer_block_flops(x.shape[1], x.shape[2], module.mlp.fc1.out_features)
+    if kind in ('linear', 'projection_head'):
+        return linear_flops(module, x.numel() // x.shape[-1])
+    return 0
+
+
+def list_units(model):
+    """
+    (name, kind, module) of the analyzed parts of the model, in forward order.
+    """
+    units = [('patch_embed', 'patch_embed', model.patch_embed)]
+    units += [('blocks.%d' % i, 'block', blk) for i, blk in enumerate(model.blocks)]
+    units.append(('norm', 'norm', model.norm))
+    if model.aligned_feature_projection_heads is not None:
+        units += [('projection_heads.%d (block %d)' % (i, blk_idx), 'projection_head', head) for i, (blk_idx, head) in
+                  enumerate(zip(model.aligned_blks_indices, model.aligned_feature_projection_heads))]
+    units.append(('decoder_embed', 'linear', model.decoder_embed))
+    units += [('decoder_blocks.%d' % i, 'decoder_block', blk) for i, blk in enumerate(model.decoder_blocks)]
+    units.append(('decoder_norm', 'norm', model.decoder_norm))
+    units.append(('decoder_pred', 'linear', model.decoder_pred))
+    return units
+
+
+class BlockAnalyzer(object):
+    """
+    Forward hooks attributing time, FLOPs and the activations autograd saves to the unit
+    that is running. Parameters saved for backward (e.g. the weights of nn.Linear) are not
+    counted as activations; a tensor saved several times within a unit is counted once.
+    """
+
+    def __init__(self, model, units):
+        self.units = units
+        self.param_ptrs = {p.data_ptr() for p in model.parameters()}
+        self.current = None
+        self.saved_ptrs = set()
+        self.start = 0.
+        self.time = defaultdict(float)
+        self.flops = {}
+        self.activation_bytes = {}
+        self.tokens = {}
+        self.handles = []
+        for name, kind, module in units:
+            self.handles.append(module.register_forward_pre_hook(self._pre_hook(name, kind)))
+            self.handles.append(module.register_forward_hook(self._post_hook(name)))
+
+    def _pre_hook(self, name, kind):
+        def hook(module, inputs):
+            x = inputs[0]
+            self.flops[name] = unit_flops(kind, module, x)
+            self.tokens[name] = x.shape[1] if x.dim() == 3 else None
+            self.activation_bytes[name] = 0
+            self.saved_ptrs = set()
+            self.current = name
+            self.start = time.perf_counter()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            self.time[name] += time.perf_counter() - self.start
+            self.current = None
+        return hook
+
+    def pack(self, tensor):
+        if self.current is not None and tensor.data_ptr() not in self.param_ptrs \
+                and tensor.data_ptr() not in self.saved_ptrs:
+            self.saved_ptrs.add(tensor.data_ptr())
+            self.activation_bytes[self.current] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def reset_time(self):
+        self.time = defaultdict(float)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def build_model(args):
+    kwargs = {}
+    if args.aligned_blks_indices is not None:
+        kwargs = dict(embedding_distillation_func='L1', aligned_blks_indices=args.aligned_blks_indices,
+                      student_reconstruction_target='original_img')
+    if args.aligned_feature_projection_mode is not None:
+        assert args.aligned_blks_indices is not None, 'projection heads need --aligned_blks_indices'
+        embed_dim, _ = encoder_of(args.model)
+        kwargs.update(aligned_feature_projection_mode=args.aligned_feature_projection_mode,
+                      aligned_feature_projection_dim=[embed_dim, args.teacher_dim])
+    return models_mae_distill.__dict__[args.model](img_size=args.input_size, **kwargs)
+
+
+def make_forward(model, args):
+    """A training forward of the model on random images: distillation student or plain MAE."""
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+    if args.aligned_blks_indices is None:
+        def forward():
+            latent, mask, ids_restore = model.forward_encoder(imgs, args.mask_ratio)
+            pred = model.forward_decoder(latent, ids_restore)
+            return model.forward_loss(imgs, pred, mask)
+        return forward
+
+    num_patches = model.patch_embed.num_patches
+    _, mask, ids_restore, ids_keep = model.random_masking_customized(
+        torch.zeros(args.batch_size, num_patches, 1), args.mask_ratio)
+    num_tokens = 1 + ids_keep.shape[1]
+    embed_dim = model.cls_token.shape[-1]
+    teacher_dim = args.teacher_dim if args.aligned_feature_projection_mode is not None else embed_dim
+    latents_teacher = [torch.randn(args.batch_size, num_tokens, teacher_dim) for _ in args.aligned_blks_indices]
+    latents_teacher.append(torch.randn(args.batch_size, num_tokens, teacher_dim))
+    teacher_prediction = torch.randn(args.batch_size, num_patches, model.decoder_pred.out_features)
+
+    def forward():
+        loss, loss_distillation_embedding, _, _ = model(imgs, ids_keep, ids_restore, mask, teacher_prediction,
+                                                        None, latents_teacher)
+        return loss + sum(loss_distillation_embedding.values())
+    return forward
+
+
+def analyze(model, args):
+    units = list_units(model)
+    analyzer = BlockAnalyzer(model, units)
+    forward = make_forward(model, args)
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(analyzer.pack, lambda tensor: tensor):
+        for _ in range(args.warmup):
+            forward()
+        analyzer.reset_time()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            forward()
+        total_ms = (time.perf_counter() - start) / args.repeats * 1000.
+    analyzer.remove()
+
+    rows = []
+    for name, kind, module in units:
+        rows.append(OrderedDict(
+            name=name, kind=kind, tokens=analyzer.tokens[name],
+            params=sum(p.numel() for p in module.parameters()),
+            gflops=analyzer.flops[name] / 1e9,
+            latency_ms=analyzer.time[name] / args.repeats * 1000.,
+            activation_mb=analyzer.activation_bytes[name] / 2 ** 20))
+    return rows, total_ms
+
+
+def main(args):
+    if args.cpu_threads > 0:
+        torch.set_num_threads(args.cpu_threads)
+    torch.manual_seed(0)
+    model = build_model(args)
+    rows, total_ms = analyze(model, args)
+
+    print('{} mask_ratio {} batch {} on {} threads'.format(args.model, args.mask_ratio, args.batch_size,
+                                                           torch.get_num_threads()))
+    print('{:<32}{:>8}{:>12}{:>10}{:>12}{:>10}{:>10}'.format('unit', 'tokens', 'params', 'GFLOPs', 'latency ms',
+                                                            '% time', 'act MB'))
+    total_unit_ms = sum(r['latency_ms'] for r in rows)
+    for r in rows:
+        print('{:<32}{:>8}{:>12,}{:>10.2f}{:>12.2f}{:>10.1%}{:>10.1f}'.format(
+            r['name'], r['tokens'] if r['tokens'] is not None else '-', r['params'], r['gflops'], r['latency_ms'],
+            r['latency_ms'] / total_ms, r['activation_mb']))
+    totals = OrderedDict(
+        params=sum(p.numel() for p in model.parameters()),
+        gflops=sum(r['gflops'] for r in rows),
+        forward_ms=total_ms,
+        # masking, pos embeds, losses and the rest of the forward
+        other_ms=total_ms - total_unit_ms,
+        activation_mb=sum(r['activation_mb'] for r in rows))
+    print('{:<32}{:>8}{:>12,}{:>10.2f}{:>12.2f}{:>10}{:>10.1f}   (other: {:.2f} ms)'.format(
+        'total', '', totals['params'], totals['gflops'], totals['forward_ms'], '', totals['activation_mb'],
+        totals['other_ms']))
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump({'torch': torch.__version__, 'num_threads': torch.get_num_threads(), 'args': vars(args),
+                       'units': rows, 'totals': totals}, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,146 @@
+# --------------------------------------------------------
+# Scaling of multi-process (gloo) data-parallel distillation on one CPU node
+#
+# Every world size in --world_sizes is launched with torch.multiprocessing, each
+# process pinned to its own block of cores, and runs engine_distill.train_one_epoch
+# on synthetic images, with the student built by main_distill.build_student. --ddp_modes
+# compares its DDP wrappers (static graph vs find_unused_parameters) by their backward
+# time. Usage (from the repository root):
+#   python -m benchmarks.bench_cpu_scaling --world_sizes 1 2 4 8 --precision bf16
+#   python -m benchmarks.bench_cpu_scaling --world_sizes 4 --ddp_modes static_graph find_unused
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import main_distill
+import util.misc as misc
+import models.models_mae_distill as models_mae_distill
+from engine_distill import teacher_forward, train_one_epoch
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('CPU data-parallel distillation scaling benchmark', add_help=False)
+    parser.add_argument('--world_sizes', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--model', default='mae_vit_tiny_patch16_dec512d2b', type=str)
+    parser.add_argument('--model_teacher', default='mae_vit_small_patch16_dec512d8b', type=str)
+    parser.add_argument('--aligned_blks_indices', nargs='+', type=int, default=[8])
+    parser.add_argument('--aligned_feature_projection_dim', nargs='+', type=int, default=[192, 384])
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--mask_ratio', default=0.75, type=float)
+    parser.add_argument('--batch_size', default=16, type=int, help='batch size per process')
+    parser.add_argument('--steps', default=10, type=int, help='timed steps per process')
+    parser.add_argument('--warmup_steps', default=2, type=int)
+    parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'bf16'])
+    parser.add_argument('--cpu_threads', default=0, type=int)
+    parser.add_argument('--ddp_modes', nargs='+', type=str, default=['static_graph'],
+                        choices=['static_graph', 'find_unused'],
+                        help='student DDP wrappers to run: static graph with gradients as bucket views '
+                             '(main_distill.py default) or find_unused_parameters (--ddp_find_unused_parameters)')
+    parser.add_argument('--output_json', default=None, type=str)
+    return parser
+
+
+def distill_args(args, *extra_args):
+    """
+    main_distill.py args of a one-epoch, fixed-lr run with the models and settings of the
+    benchmark args, plus extra_args (command line style); nothing is logged or saved.
+    """
+    train_args = main_distill.get_args_parser().parse_args([
+        '--device', 'cpu', '--model', args.model, '--model_teacher', args.model_teacher,
+        '--input_size', str(args.input_size), '--mask_ratio', str(args.mask_ratio), '--precision', args.precision,
+        '--aligned_blks_indices', *[str(i) for i in args.aligned_blks_indices],
+        '--aligned_feature_projection_dim', *[str(d) for d in args.aligned_feature_projection_dim],
+        '--embedding_distillation_func', 'L1', '--student_reconstruction_target', 'original_img',
+        '--lr', '1e-4', '--warmup_epochs', '0', '--epochs', '1', '--fixed_lr', '--opt_impl', 'foreach',
+        '--output_dir', '', *extra_args])
+    train_args.log_dir = None
+    return train_args
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def synthetic_loader(args, num_steps, world_size, rank):
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn(num_steps * args.batch_size * world_size, 3, args.input_size, args.input_size),
+        torch.zeros(num_steps * args.batch_size * world_size))
+    sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=False)
+    return torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=args.batch_size, drop_last=True)
+
+
+def worker(rank, world_size, ddp_mode, port, args, results):
+    cores = misc.setup_cpu_threads(rank, world_size, args.cpu_threads)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, world_size=world_size, rank=rank)
+    misc.setup_for_distributed(rank == 0)
+    device = torch.device('cpu')
+    torch.manual_seed(rank)
+
+    ddp_args = ['--ddp_find_unused_parameters'] if ddp_mode == 'find_unused' else []
+    train_args = distill_args(args, '--profile', *ddp_args)
+    train_args.distributed = True
+
+    model_teacher = models_mae_distill.__dict__[args.model_teacher](
+        img_size=args.input_size, embedding_distillation_func='L1',
+        aligned_blks_indices=args.aligned_blks_indices)
+    model_teacher.requires_grad_(False)
+    # the student as main_distill.py builds it: frozen and unused parameters left out of DDP
+    probe_imgs = torch.randn(2, 3, args.input_size, args.input_size)
+    probe_batch = (probe_imgs, teacher_forward(model_teacher, probe_imgs, device, train_args))
+    student, _ = main_distill.build_student('', train_args, device, None, probe_batch)
+    model, optimizer, loss_scaler = student.model, student.optimizer, student.loss_scaler
+
+    train_one_epoch(model, model_teacher, synthetic_loader(args, args.warmup_steps, world_size, rank),
+                    optimizer, device, 0, loss_scaler, args=train_args)
+    dist.barrier()
+    start = time.perf_counter()
+    stats = train_one_epoch(model, model_teacher, synthetic_loader(args, args.steps, world_size, rank),
+                    optimizer, device, 0, loss_scaler, args=train_args)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        results.put({'ddp_mode': ddp_mode, 'world_size': world_size, 'threads_per_proc': torch.get_num_threads(),
+                     'cores_per_proc': len(cores), 'seconds': elapsed,
+                     'images_per_s': args.steps * args.batch_size * world_size / elapsed,
+                     'backward_ms': stats['time_backward']})
+    dist.destroy_process_group()
+
+
+def main(args):
+    ctx = mp.get_context('spawn')
+    results = []
+    for ddp_mode in args.ddp_modes:
+        for world_size in args.world_sizes:
+            queue = ctx.SimpleQueue()
+            mp.start_processes(worker, args=(world_size, ddp_mode, free_port(), args, queue), nprocs=world_size,
+                               start_method='spawn')
+            results.append(queue.get())
+
+    print('ddp_mode\tworld_size\tthreads/proc\timages/s\tbackward ms\tspeedup\tefficiency')
+    for r in results:
+        first = next(f for f in results if f['ddp_mode'] == r['ddp_mode'])
+        r['speedup'] = r['images_per_s'] / first['images_per_s']
+        r['efficiency'] = r['images_per_s'] / (first['images_per_s'] / first['world_size'] * r['world_size'])
+        print('{ddp_mode}\t{world_size}\t{threads_per_proc}\t{images_per_s:.2f}\t{backward_ms:.1f}\t'
+              '{speedup:.2f}\t{efficiency:.2f}'.format(**r))
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
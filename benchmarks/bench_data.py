@@ -0,0 +1,228 @@
+# --------------------------------------------------------
+# Data-pipeline benchmark on synthetic chest X-ray fixtures
+#
+# Writes a ChestX-ray14-like tree (1024x1024 grayscale PNGs + list file) and a
+# CheXpert-small-like tree (~320x390 JPEGs + train.csv), measures the per-sample cost
+# of each stage of __getitem__ (open, decode, resize, to-tensor/normalize) and of
+# collation, then sweeps DataLoader num_workers x batch_size x prefetch_factor and
+# recommends loader settings. Usage (from the repository root):
+#   python -m benchmarks.bench_data --fixture_dir /tmp/cxr_fixtures --workers 0 2 4 8 10
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+from torchvision import transforms
+
+from util.dataloader_medical import CheXpert, ChestX_ray14
+
+MEAN = [0.5056, 0.5056, 0.5056]
+STD = [0.252, 0.252, 0.252]
+
+CHEXPERT_COLUMNS = ['No Finding', 'Enlarged Cardiomediastinum', 'Cardiomegaly', 'Lung Opacity', 'Lung Lesion',
+                    'Edema', 'Consolidation', 'Pneumonia', 'Atelectasis', 'Pneumothorax', 'Pleural Effusion',
+                    'Pleural Other', 'Fracture', 'Support Devices']
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Data-pipeline benchmark', add_help=False)
+    parser.add_argument('--fixture_dir', default='./work_dirs/data_fixtures', type=str,
+                        help='where the synthetic datasets are written (reused if present)')
+    parser.add_argument('--datasets', nargs='+', type=str, default=['chestxray14', 'chexpert'])
+    parser.add_argument('--num_images', default=512, type=int)
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--stage_samples', default=64, type=int, help='samples timed per stage')
+    parser.add_argument('--workers', nargs='+', type=int, default=[0, 2, 4, 8, 10])
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[32, 64])
+    parser.add_argument('--prefetch_factors', nargs='+', type=int, default=[2, 4])
+    parser.add_argument('--batches', default=20, type=int, help='timed batches per loader setting')
+    parser.add_argument('--pin_mem', action='store_true')
+    parser.add_argument('--target', default=0.95, type=float,
+                        help='recommend the fewest workers reaching this fraction of the best throughput')
+    parser.add_argument('--output_json', default=None, type=str, help='where to write the results')
+    return parser
+
+
+def synthetic_radiograph(rng, height, width):
+    """A smooth grayscale image with film grain, so that PNG/JPEG sizes are realistic."""
+    coarse = Image.fromarray(rng.integers(40, 220, size=(16, 16), dtype=np.uint8))
+    image = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.float32)
+    image += rng.normal(0, 6, size=(height, width))
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8), mode='L')
+
+
+def make_chestxray14(root, num_images, rng):
+    image_dir = os.path.join(root, 'images')
+    list_file = os.path.join(root, 'train_official.txt')
+    if os.path.exists(list_file):
+        return image_dir, list_file
+    os.makedirs(image_dir, exist_ok=True)
+    with open(list_file, 'w') as f:
+        for i in range(num_images):
+            name = '%08d_000.png' % i
+            synthetic_radiograph(rng, 1024, 1024).save(os.path.join(image_dir, name))
+            f.write(' '.join([name] + [str(v) for v in rng.integers(0, 2, size=14)]) + '\n')
+    return image_dir, list_file
+
+
+def make_chexpert(root, num_images, rng):
+    csv_path = os.path.join(root, 'train.csv')
+    if os.path.exists(csv_path):
+        return root + '/', csv_path
+    rows = []
+    for i in range(num_images):
+        path = 'CheXpert-v1.0-small/train/patient%05d/study1/view1_frontal.jpg' % i
+        os.makedirs(os.path.join(root, os.path.dirname(path).replace('CheXpert-v1.0-small/', '')), exist_ok=True)
+        synthetic_radiograph(rng, 390, 320).save(os.path.join(root, path.replace('CheXpert-v1.0-small/', '')),
+                                                 quality=90)
+        # -1 (uncertain), nan (unmentioned), 0 and 1 as in the real csv
+        labels = rng.choice([-1., np.nan, 0., 1.], size=len(CHEXPERT_COLUMNS))
+        labels[i % len(CHEXPERT_COLUMNS)] = i % 2
+        rows.append([path, 'Female', 60, 'Frontal', 'AP'] + labels.tolist())
+    columns = ['Path', 'Sex', 'Age', 'Frontal/Lateral', 'AP/PA'] + CHEXPERT_COLUMNS
+    pd.DataFrame(rows, columns=columns).to_csv(csv_path, index=False)
+    return root + '/', csv_path
+
+
+def build_dataset(name, args, transform):
+    rng = np.random.default_rng(0)
+    root = os.path.join(args.fixture_dir, name)
+    if name == 'chestxray14':
+        image_dir, list_file = make_chestxray14(root, args.num_images, rng)
+        return ChestX_ray14(image_dir, list_file, augment=transform, num_class=14, heatmap_path=None,
+                            pretraining=False)
+    elif name == 'chexpert':
+        image_root, csv_path = make_chexpert(root, args.num_images, rng)
+        return CheXpert(csv_path=csv_path, image_root_path=image_root, use_upsampling=False, use_frontal=True,
+                        mode='train', class_index=-1, transform=transform, heatmap_path=None, pretraining=False,
+                        verbose=False)
+    raise NotImplementedError
+
+
+def image_paths(dataset):
+    return dataset.img_list if isinstance(dataset, ChestX_ray14) else dataset._images_list
+
+
+def time_stages(dataset, args):
+    """
+    Mean milliseconds per sample of every stage of __getitem__ with the training transform,
+    plus collation of one batch of the largest batch size, per sample.
+    """
+    resize = transforms.Compose([transforms.Resize((args.input_size, args.input_size)),
+                                 transforms.RandomHorizontalFlip()])
+    to_tensor = transforms.Compose([transforms.ToTensor(), transforms.Normalize(MEAN, STD)])
+    totals = {'open': 0., 'decode': 0., 'resize': 0., 'transform': 0.}
+    paths = image_paths(dataset)[:args.stage_samples]
+    samples = []
+    for path in paths:
+        t0 = time.perf_counter()
+        image = Image.open(path)
+        t1 = time.perf_counter()
+        image = image.convert('RGB')
+        t2 = time.perf_counter()
+        image = resize(image)
+        t3 = time.perf_counter()
+        image = to_tensor(image)
+        t4 = time.perf_counter()
+        totals['open'] += t1 - t0
+        totals['decode'] += t2 - t1
+        totals['resize'] += t3 - t2
+        totals['transform'] += t4 - t3
+        samples.append((image, torch.zeros(14)))
+    stages = {k: v / len(paths) * 1000. for k, v in totals.items()}
+
+    batch = [samples[i % len(samples)] for i in range(max(args.batch_sizes))]
+    start = time.perf_counter()
+    default_collate(batch)
+    stages['collate'] = (time.perf_counter() - start) / len(batch) * 1000.
+    stages['total'] = sum(stages.values())
+    return stages
+
+
+def time_loader(dataset, num_workers, batch_size, prefetch_factor, args):
+    """Loader timings, or None when the dataset has fewer than two batches of batch_size."""
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                        pin_memory=args.pin_mem, drop_last=True,
+                        prefetch_factor=prefetch_factor if num_workers > 0 else None)
+    # the first batch is timed on its own, the throughput needs at least one more
+    if len(loader) < 2:
+        return None
+    num_batches = min(args.batches, len(loader) - 1)
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator)
+    first_batch_s = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    elapsed = time.perf_counter() - start
+    del iterator
+    return {'num_workers': num_workers, 'batch_size': batch_size, 'prefetch_factor': prefetch_factor,
+            'first_batch_s': first_batch_s, 'samples_per_s': num_batches * batch_size / elapsed}
+
+
+def recommend(sweep, target):
+    """
+    The fewest workers (then the smallest prefetch factor) within `target` of the best
+    throughput: more workers take cores and memory from the training processes.
+    """
+    best = max(r['samples_per_s'] for r in sweep)
+    good = [r for r in sweep if r['samples_per_s'] >= target * best]
+    return min(good, key=lambda r: (r['num_workers'], r['prefetch_factor'], -r['samples_per_s']))
+
+
+def main(args):
+    transform = transforms.Compose([
+        transforms.Resize((args.input_size, args.input_size)),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize(MEAN, STD)])
+    report = {'cpu_count': os.cpu_count(), 'args': vars(args), 'datasets': {}}
+
+    for name in args.datasets:
+        dataset = build_dataset(name, args, transform)
+        stages = time_stages(dataset, args)
+        print('{}: per-sample ms  '.format(name) + '  '.join('{} {:.2f}'.format(k, v) for k, v in stages.items()))
+
+        sweep = []
+        print('num_workers\tbatch_size\tprefetch\tfirst batch s\tsamples/s')
+        for num_workers in args.workers:
+            for batch_size in args.batch_sizes:
+                # prefetch_factor only applies with worker processes
+                for prefetch_factor in (args.prefetch_factors if num_workers > 0 else [args.prefetch_factors[0]]):
+                    r = time_loader(dataset, num_workers, batch_size, prefetch_factor, args)
+                    if r is None:
+                        print('{}\t{}\t{}\tskipped: fewer than 2 batches of {} images'.format(
+                            num_workers, batch_size, prefetch_factor, len(dataset)))
+                        continue
+                    sweep.append(r)
+                    print('{num_workers}\t{batch_size}\t{prefetch_factor}\t{first_batch_s:.2f}\t{samples_per_s:.1f}'
+                          .format(**r))
+
+        if not sweep:
+            print('{}: no sweep point has two batches, increase --num_images'.format(name))
+            continue
+        best = recommend(sweep, args.target)
+        print('{}: recommended --num_workers {} (prefetch_factor {}, batch size {}): {:.1f} samples/s, '
+              'single-process estimate {:.1f} samples/s'.format(name, best['num_workers'], best['prefetch_factor'],
+                                                                 best['batch_size'], best['samples_per_s'],
+                                                                 1000. / stages['total']))
+        report['datasets'][name] = {'stages_ms': stages, 'sweep': sweep, 'recommended': best}
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,176 @@
+# --------------------------------------------------------
+# Microbenchmarks of the per-step helpers of models_mae_distill.MaskedAutoencoderViT
+#
+# random_masking(_customized), patchify / unpatchify, the decoder unshuffle, every
+# forward_loss* variant and forward_distillation_loss_embedding for each projection
+# mode, across batch sizes and encoder embed dims, timed with torch.utils.benchmark.
+# Usage (from the repository root):
+#   python -m benchmarks.bench_kernels --output_json kernels.json
+#   python -m benchmarks.bench_kernels --baseline kernels.json
+# --------------------------------------------------------
+
+import argparse
+import json
+import sys
+from functools import partial
+
+import torch
+import torch.nn as nn
+from torch.utils import benchmark
+
+from models.models_mae_distill import MaskedAutoencoderViT
+
+PROJECTION_MODES = ['none', 'fc-1layer', 'mlp-1layer', 'mlp-2layer']
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('MAE helper microbenchmarks', add_help=False)
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[8, 32, 64])
+    parser.add_argument('--embed_dims', nargs='+', type=int, default=[192, 384, 768])
+    parser.add_argument('--teacher_dim', default=768, type=int,
+                        help='teacher feature dim the projection heads map to')
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--mask_ratio', default=0.75, type=float)
+    parser.add_argument('--ops', nargs='+', type=str, default=None, help='only these ops (default: all)')
+    parser.add_argument('--backward', action='store_true',
+                        help='time forward + backward for the losses and projection heads')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--num_threads', default=torch.get_num_threads(), type=int)
+    parser.add_argument('--min_run_time', default=0.2, type=float, help='seconds of measurement per op')
+    parser.add_argument('--output_json', default=None, type=str, help='where to write the results')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative slowdown reported as a regression')
+    return parser
+
+
+def build_model(embed_dim, args, projection_mode='none'):
+    # one encoder and one decoder block: the helpers under test do not depend on depth
+    kwargs = {}
+    if projection_mode != 'none':
+        kwargs = dict(aligned_feature_projection_mode=projection_mode,
+                      aligned_feature_projection_dim=[embed_dim, args.teacher_dim])
+    model = MaskedAutoencoderViT(
+        img_size=args.input_size, patch_size=16, embed_dim=embed_dim, depth=1, num_heads=embed_dim // 64,
+        decoder_embed_dim=512, decoder_depth=1, decoder_num_heads=16, mlp_ratio=4,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6), embedding_distillation_func='L1', aligned_blks_indices=[0],
+        **kwargs)
+    return model.to(args.device)
+
+
+def loss_op(loss_fn, pred, backward):
+    def run():
+        loss = loss_fn(pred)
+        if backward:
+            loss.backward()
+    return run
+
+
+def make_ops(model, batch_size, embed_dim, args):
+    """
+    (name, fn) pairs for one model, batch size and embed dim.
+    """
+    device = torch.device(args.device)
+    num_patches = model.patch_embed.num_patches
+    patch_dim = model.patch_embed.patch_size[0] ** 2 * 3
+    len_keep = int(num_patches * (1 - args.mask_ratio))
+
+    imgs = torch.randn(batch_size, 3, args.input_size, args.input_size, device=device)
+    tokens = torch.randn(batch_size, num_patches, embed_dim, device=device)
+    patches = torch.randn(batch_size, num_patches, patch_dim, device=device)
+    _, mask, ids_restore = model.random_masking(tokens, args.mask_ratio)
+    decoder_tokens = torch.randn(batch_size, 1 + len_keep, 512, device=device)
+    teacher_pred = torch.randn(batch_size, num_patches, patch_dim, device=device)
+
+    def pred_of(width):
+        return torch.randn(batch_size, num_patches, width, device=device, requires_grad=args.backward)
+
+    ops = [
+        ('random_masking', lambda: model.random_masking(tokens, args.mask_ratio)),
+        ('random_masking_customized', lambda: model.random_masking_customized(tokens, args.mask_ratio)),
+        ('patchify', lambda: model.patchify(imgs)),
+        ('unpatchify', lambda: model.unpatchify(patches)),
+        ('decoder_unshuffle', lambda: model.unshuffle_tokens(decoder_tokens, ids_restore)),
+        ('forward_loss', loss_op(lambda p: model.forward_loss(imgs, p, mask), pred_of(patch_dim), args.backward)),
+        ('forward_loss_disentangle_mixup', loss_op(
+            lambda p: model.forward_loss_disentangle_mixup(imgs, p, mask, imgs), pred_of(3 * patch_dim),
+            args.backward)),
+        ('forward_loss_student', loss_op(
+            lambda p: model.forward_loss_student(teacher_pred, p, mask), pred_of(patch_dim), args.backward)),
+        ('forward_loss_student_diff', loss_op(
+            lambda p: model.forward_loss_student_diff(imgs, teacher_pred, p, mask), pred_of(patch_dim),
+            args.backward)),
+        ('forward_loss_student_weighted_sum', loss_op(
+            lambda p: model.forward_loss_student_weighted_sum(imgs, teacher_pred, p, mask), pred_of(patch_dim),
+            args.backward)),
+        ('forward_loss_student_disentangled', loss_op(
+            lambda p: model.forward_loss_student_disentangled(imgs, teacher_pred, p, mask), pred_of(2 * patch_dim),
+            args.backward)),
+    ]
+    return ops
+
+
+def make_embedding_ops(batch_size, embed_dim, args):
+    device = torch.device(args.device)
+    num_tokens = 1 + int(args.input_size // 16 * args.input_size // 16 * (1 - args.mask_ratio))
+    ops = []
+    for mode in PROJECTION_MODES:
+        model = build_model(embed_dim, args, projection_mode=mode)
+        teacher_dim = args.teacher_dim if mode != 'none' else embed_dim
+        features_teacher = [torch.randn(batch_size, num_tokens, teacher_dim, device=device)]
+        features_student = [torch.randn(batch_size, num_tokens, embed_dim, device=device,
+                                        requires_grad=args.backward)]
+
+        def run(model=model, features_teacher=features_teacher, features_student=features_student):
+            losses = model.forward_distillation_loss_embedding(features_teacher, features_student)
+            if args.backward:
+                sum(losses.values()).backward()
+        ops.append(('distillation_loss_embedding/' + mode, run))
+    return ops
+
+
+def main(args):
+    results = []
+    print('op\tbatch_size\tembed_dim\tmedian ms\tIQR ms')
+    for embed_dim in args.embed_dims:
+        model = build_model(embed_dim, args)
+        for batch_size in args.batch_sizes:
+            ops = make_ops(model, batch_size, embed_dim, args) + make_embedding_ops(batch_size, embed_dim, args)
+            for name, fn in ops:
+                if args.ops is not None and name.split('/')[0] not in args.ops:
+                    continue
+                timer = benchmark.Timer(stmt='fn()', globals={'fn': fn}, num_threads=args.num_threads,
+                                        label=name, sub_label='N={} D={}'.format(batch_size, embed_dim))
+                measurement = timer.blocked_autorange(min_run_time=args.min_run_time)
+                result = {'op': name, 'batch_size': batch_size, 'embed_dim': embed_dim,
+                          'median_ms': measurement.median * 1000., 'iqr_ms': measurement.iqr * 1000.}
+                results.append(result)
+                print('{op}\t{batch_size}\t{embed_dim}\t{median_ms:.4f}\t{iqr_ms:.4f}'.format(**result))
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump({'device': args.device, 'torch': torch.__version__, 'args': vars(args), 'results': results},
+                      f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = {(r['op'], r['batch_size'], r['embed_dim']): r for r in json.load(f)['results']}
+        regressions = []
+        for r in results:
+            b = baseline.get((r['op'], r['batch_size'], r['embed_dim']))
+            if b is None:
+                continue
+            change = r['median_ms'] / b['median_ms'] - 1
+            if change > args.tolerance:
+                regressions.append('{} N={} D={} ({:+.1%})'.format(r['op'], r['batch_size'], r['embed_dim'], change))
+        if regressions:
+            print('Regressions beyond {:.0%}:\n  {}'.format(args.tolerance, '\n  '.join(regressions)))
+            sys.exit(1)
+        print('No regressions beyond {:.0%} against {}'.format(args.tolerance, args.baseline))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
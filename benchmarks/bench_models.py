@@ -0,0 +1,261 @@
+# --------------------------------------------------------
+# End-to-end training-step throughput of the model factories on synthetic data
+#
+# Times forward / backward / optimizer phases for every models_mae_distill (MAE
+# pre-training step) and models_vit (classification step) factory, and full
+# distillation steps for teacher:student pairs. Each case runs in its own process
+# so the reported peak memory is its own. Usage (from the repository root):
+#   python -m benchmarks.bench_models --device cpu --output_json bench.json
+#   python -m benchmarks.bench_models --models vit_tiny_patch16 --pairs none --baseline bench.json
+# --------------------------------------------------------
+
+import argparse
+import contextlib
+import json
+import os
+import re
+import resource
+import sys
+import time
+from collections import defaultdict
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+
+import util.misc as misc
+import models.models_mae_distill as models_mae_distill
+from models import models_vit
+
+# embed dim and depth of the encoders, by the size in the factory name
+ENCODERS = {'tiny': (192, 12), 'small': (384, 12), 'base': (768, 12), 'large': (1024, 24), 'huge': (1280, 32)}
+
+DEFAULT_PAIRS = ['mae_vit_base_patch16_dec512d8b:mae_vit_tiny_patch16_dec512d2b',
+                 'mae_vit_small_patch16_dec512d8b:mae_vit_tiny_patch16_dec512d2b']
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Model training-step throughput benchmark', add_help=False)
+    parser.add_argument('--models', nargs='+', type=str, default=['all'],
+                        help='models_mae_distill / models_vit factories, "all" or "none"')
+    parser.add_argument('--pairs', nargs='+', type=str, default=DEFAULT_PAIRS,
+                        help='teacher:student distillation pairs, or "none"')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--mask_ratio', default=0.75, type=float)
+    parser.add_argument('--nb_classes', default=14, type=int)
+    parser.add_argument('--aligned_blks_indices', nargs='+', type=int, default=[8],
+                        help='student blocks aligned in distillation; teacher blocks are picked at the same depth fraction')
+    parser.add_argument('--warmup', default=2, type=int, help='untimed steps')
+    parser.add_argument('--steps', default=5, type=int, help='timed steps')
+    parser.add_argument('--cpu_threads', default=0, type=int, help='torch threads (0: torch default)')
+    parser.add_argument('--no_isolate', action='store_false', dest='isolate',
+                        help='run all cases in this process (peak RSS is then cumulative)')
+    parser.set_defaults(isolate=True)
+    parser.add_argument('--output_json', default=None, type=str, help='where to write the results')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='relative drop in images/s (or growth in peak memory) reported as a regression')
+    return parser
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+class PhaseTimer(object):
+    def __init__(self, device):
+        self.device = device
+        self.totals = defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        synchronize(self.device)
+        start = time.perf_counter()
+        yield
+        synchronize(self.device)
+        self.totals[name] += time.perf_counter() - start
+
+
+def encoder_of(model_name):
+    return ENCODERS[re.search(r'vit_(tiny|small|base|large|huge)', model_name).group(1)]
+
+
+def build_case(case, args, device):
+    """
+    Model(s), optimizer and a step function taking (imgs, targets, timer) for one case.
+    """
+    if case['kind'] == 'vit':
+        model = models_vit.__dict__[case['model']](img_size=args.input_size, num_classes=args.nb_classes,
+                                                   global_pool=True)
+        teacher = None
+    elif case['kind'] == 'mae':
+        model = models_mae_distill.__dict__[case['model']](img_size=args.input_size)
+        teacher = None
+    else:
+        teacher_dim, teacher_depth = encoder_of(case['teacher'])
+        student_dim, student_depth = encoder_of(case['model'])
+        teacher_blks = [teacher_depth * (i + 1) // student_depth - 1 for i in args.aligned_blks_indices]
+        model = models_mae_distill.__dict__[case['model']](
+            img_size=args.input_size, embedding_distillation_func='L1',
+            aligned_blks_indices=args.aligned_blks_indices, student_reconstruction_target='original_img',
+            aligned_feature_projection_mode='fc-1layer',
+            aligned_feature_projection_dim=[student_dim, teacher_dim])
+        teacher = models_mae_distill.__dict__[case['teacher']](
+            img_size=args.input_size, embedding_distillation_func='L1', aligned_blks_indices=teacher_blks)
+        teacher.to(device).eval()
+    model.to(device).train()
+
+    optimizer = misc.create_adamw(model.parameters(), argparse.Namespace(lr=1e-4, opt_impl='foreach'))
+    # backward and the optimizer step are timed separately, so the scaler is used directly
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16' and device.type == 'cuda')
+
+    def step(imgs, targets, timer):
+        if teacher is not None:
+            with timer('teacher'), torch.no_grad(), misc.autocast(device, args.precision):
+                latents_teacher, mask, ids_restore, ids_keep = \
+                    teacher.forward_encoder_customized(imgs, args.mask_ratio)
+                teacher_prediction = teacher.forward_decoder(latents_teacher[-1], ids_restore)
+        with timer('forward'), misc.autocast(device, args.precision):
+            if case['kind'] == 'vit':
+                loss = F.binary_cross_entropy_with_logits(model(imgs).float(), targets)
+            elif case['kind'] == 'mae':
+                latent, mask, ids_restore = model.forward_encoder(imgs, args.mask_ratio)
+                pred = model.forward_decoder(latent, ids_restore)
+                loss = model.forward_loss(imgs, pred, mask)
+            else:
+                loss, loss_distillation_embedding, _, _ = model(imgs, ids_keep, ids_restore, mask,
+                                                                teacher_prediction, None, latents_teacher)
+                for loss_v in loss_distillation_embedding.values():
+                    loss = loss + loss_v
+        with timer('backward'):
+            scaler.scale(loss).backward()
+        with timer('optimizer'):
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+    num_params = sum(p.numel() for p in model.parameters())
+    if teacher is not None:
+        num_params += sum(p.numel() for p in teacher.parameters())
+    return step, num_params
+
+
+def run_case(case, args):
+    device = torch.device(args.device)
+    if args.cpu_threads > 0:
+        torch.set_num_threads(args.cpu_threads)
+    torch.manual_seed(0)
+    step, num_params = build_case(case, args, device)
+    imgs = torch.randn(args.batch_size, 3, args.input_size, args.input_size, device=device)
+    targets = (torch.rand(args.batch_size, args.nb_classes, device=device) > 0.5).float()
+
+    for _ in range(args.warmup):
+        step(imgs, targets, PhaseTimer(device))
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    timer = PhaseTimer(device)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step(imgs, targets, timer)
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    if device.type == 'cuda':
+        peak_memory_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        # ru_maxrss is in KB on Linux: the peak resident size of this process
+        peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return {
+        'name': case['name'], 'kind': case['kind'], 'num_params': num_params,
+        'images_per_s': args.steps * args.batch_size / elapsed,
+        'step_ms': elapsed / args.steps * 1000.,
+        'phases_ms': {k: v / args.steps * 1000. for k, v in timer.totals.items()},
+        'peak_memory_mb': peak_memory_mb,
+    }
+
+
+def _isolated_worker(case, args, results):
+    results.put(run_case(case, args))
+
+
+def list_cases(args):
+    cases = []
+    if args.models == ['all']:
+        models = sorted(n for n in models_mae_distill.__dict__ if n.startswith('mae_vit_')) + \
+            sorted(n for n in models_vit.__dict__ if n.startswith('vit_'))
+    elif args.models == ['none']:
+        models = []
+    else:
+        models = args.models
+    for name in models:
+        cases.append({'name': name, 'kind': 'mae' if name.startswith('mae_') else 'vit', 'model': name})
+    if args.pairs != ['none']:
+        for pair in args.pairs:
+            teacher, student = pair.split(':')
+            cases.append({'name': pair, 'kind': 'distill', 'model': student, 'teacher': teacher})
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change against a baseline; returns the names of the regressed cases.
+    """
+    baseline = {r['name']: r for r in baseline['results']}
+    regressions = []
+    print('name\timages/s\tbaseline\tchange\tpeak MB\tbaseline\tchange')
+    for r in results:
+        if r['name'] not in baseline:
+            continue
+        b = baseline[r['name']]
+        speed = r['images_per_s'] / b['images_per_s'] - 1
+        memory = r['peak_memory_mb'] / b['peak_memory_mb'] - 1
+        regressed = speed < -tolerance or memory > tolerance
+        if regressed:
+            regressions.append(r['name'])
+        print('{}\t{:.2f}\t{:.2f}\t{:+.1%}\t{:.0f}\t{:.0f}\t{:+.1%}{}'.format(
+            r['name'], r['images_per_s'], b['images_per_s'], speed, r['peak_memory_mb'], b['peak_memory_mb'],
+            memory, '\tREGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(args):
+    ctx = mp.get_context('spawn')
+    results = []
+    for case in list_cases(args):
+        if args.isolate:
+            queue = ctx.SimpleQueue()
+            process = ctx.Process(target=_isolated_worker, args=(case, args, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print('{} failed (exit code {})'.format(case['name'], process.exitcode))
+                continue
+            result = queue.get()
+        else:
+            result = run_case(case, args)
+        results.append(result)
+        print('{name}\t{images_per_s:.2f} images/s\t{step_ms:.1f} ms/step\t{peak_memory_mb:.0f} MB\t'.format(**result) +
+              '  '.join('{} {:.1f} ms'.format(k, v) for k, v in result['phases_ms'].items()))
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump({'device': args.device, 'torch': torch.__version__, 'cpu_count': os.cpu_count(),
+                       'args': vars(args), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions beyond {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
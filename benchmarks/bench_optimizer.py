@@ -0,0 +1,99 @@
+# --------------------------------------------------------
+# Optimizer step-time benchmark for the fine-tuning ViTs
+#
+# Usage (from the repository root):
+#   python -m benchmarks.bench_optimizer --device cuda --models vit_tiny_patch16 vit_small_patch16
+# --------------------------------------------------------
+
+import argparse
+import json
+import time
+
+import torch
+
+import util.lr_decay as lrd
+import util.misc as misc
+from models import models_vit
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Optimizer step-time benchmark', add_help=False)
+    parser.add_argument('--models', nargs='+', type=str,
+                        default=['vit_tiny_patch16', 'vit_small_patch16', 'vit_base_patch16'])
+    parser.add_argument('--opt_impls', nargs='+', type=str, default=['default', 'foreach', 'fused'])
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--nb_classes', default=14, type=int)
+    parser.add_argument('--weight_decay', type=float, default=0.05)
+    parser.add_argument('--layer_decay', type=float, default=0.55)
+    parser.add_argument('--lr', type=float, default=1e-4)
+    parser.add_argument('--warmup', default=5, type=int, help='untimed steps')
+    parser.add_argument('--iters', default=20, type=int, help='timed steps')
+    parser.add_argument('--output_json', default=None, type=str, help='where to write the results')
+    return parser
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def legacy_grad_norm(parameters, norm_type=2.0):
+    """The per-parameter list + stack grad norm, kept as the reference for the benchmark."""
+    parameters = [p for p in parameters if p.grad is not None]
+    device = parameters[0].grad.device
+    return torch.norm(torch.stack([torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]),
+                      norm_type)
+
+
+def time_fn(fn, device, warmup, iters):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def bench_model(model_name, args):
+    device = torch.device(args.device)
+    model = models_vit.__dict__[model_name](num_classes=args.nb_classes, global_pool=True).to(device)
+    param_groups = lrd.param_groups_lrd(model, args.weight_decay,
+                                        no_weight_decay_list=model.no_weight_decay(),
+                                        layer_decay=args.layer_decay)
+    params = [p for p in model.parameters() if p.requires_grad]
+    for p in params:
+        p.grad = torch.randn_like(p) * 1e-3
+
+    result = {'model': model_name, 'num_params': sum(p.numel() for p in params),
+              'num_param_groups': len(param_groups)}
+    result['grad_norm_legacy_ms'] = time_fn(lambda: legacy_grad_norm(params), device, args.warmup, args.iters)
+    result['grad_norm_foreach_ms'] = time_fn(lambda: misc.get_grad_norm_(params), device, args.warmup, args.iters)
+
+    for opt_impl in args.opt_impls:
+        opt_args = argparse.Namespace(lr=args.lr, opt_impl=opt_impl)
+        # fresh group dicts: an optimizer writes its foreach / fused defaults into the ones it gets
+        optimizer = misc.create_adamw([dict(g) for g in param_groups], opt_args)
+        result[f'step_{opt_impl}_ms'] = time_fn(optimizer.step, device, args.warmup, args.iters)
+    return result
+
+
+def main(args):
+    results = [bench_model(model_name, args) for model_name in args.models]
+
+    columns = [k for k in results[0].keys() if k != 'model']
+    print('\t'.join(['model'] + columns))
+    for result in results:
+        print('\t'.join([result['model']] + ['{:.3f}'.format(result[k]) if isinstance(result[k], float)
+                                             else str(result[k]) for k in columns]))
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump({'device': args.device, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+# --------------------------------------------------------
+# Inline vs pipelined teacher (engine_distill.TeacherProcess) on one multi-core CPU node
+#
+# Runs engine_distill.train_one_epoch on synthetic images twice with the same cores:
+# once with the teacher forward inline (all --threads for one process), once with the
+# teacher in its own process (--teacher_threads for it, the rest for the student), and
+# reports images/s of both. Usage (from the repository root):
+#   python -m benchmarks.bench_teacher_pipeline --threads 16 --teacher_threads 10
+# --------------------------------------------------------
+
+import argparse
+import json
+import os
+import time
+
+import torch
+
+import util.misc as misc
+import models.models_mae_distill as models_mae_distill
+from benchmarks.bench_cpu_scaling import distill_args
+from engine_distill import TeacherProcess, train_one_epoch
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Pipelined teacher benchmark', add_help=False)
+    parser.add_argument('--model', default='mae_vit_tiny_patch16_dec512d2b', type=str)
+    parser.add_argument('--model_teacher', default='mae_vit_base_patch16_dec512d8b', type=str)
+    parser.add_argument('--aligned_blks_indices', nargs='+', type=int, default=[8])
+    parser.add_argument('--aligned_feature_projection_dim', nargs='+', type=int, default=[192, 768])
+    parser.add_argument('--input_size', default=224, type=int)
+    parser.add_argument('--mask_ratio', default=0.75, type=float)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--steps', default=10, type=int, help='timed steps')
+    parser.add_argument('--warmup_steps', default=2, type=int)
+    parser.add_argument('--precision', default='fp32', type=str, choices=['fp32', 'bf16'])
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='total intra-op threads')
+    parser.add_argument('--teacher_threads', default=0, type=int,
+                        help='threads of the teacher process (0: half of --threads)')
+    parser.add_argument('--teacher_queue_depth', default=2, type=int)
+    parser.add_argument('--output_json', default=None, type=str)
+    return parser
+
+
+def synthetic_loader(args, num_steps):
+    dataset = torch.utils.data.TensorDataset(
+        torch.randn(num_steps * args.batch_size, 3, args.input_size, args.input_size),
+        torch.zeros(num_steps * args.batch_size))
+    return torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, drop_last=True)
+
+
+def run(args, teacher_process, model, model_teacher, train_args):
+    optimizer = misc.create_adamw(model.parameters(), train_args, betas=(0.9, 0.95))
+    loss_scaler = misc.NativeScalerWithGradNormCount(enabled=False)
+    device = torch.device('cpu')
+    train_one_epoch(model, model_teacher, synthetic_loader(args, args.warmup_steps), optimizer, device, 0,
+                    loss_scaler, args=train_args, teacher_process=teacher_process)
+    start = time.perf_counter()
+    stats = train_one_epoch(model, model_teacher, synthetic_loader(args, args.steps), optimizer, device, 0,
+                            loss_scaler, args=train_args, teacher_process=teacher_process)
+    elapsed = time.perf_counter() - start
+    return {'images_per_s': args.steps * args.batch_size / elapsed,
+            'phases_ms': {k[len('time_'):]: v for k, v in stats.items() if k.startswith('time_')}}
+
+
+def main(args):
+    torch.manual_seed(0)
+    teacher_threads = args.teacher_threads or args.threads // 2
+    model = models_mae_distill.__dict__[args.model](
+        img_size=args.input_size, embedding_distillation_func='L1',
+        aligned_blks_indices=args.aligned_blks_indices, student_reconstruction_target='original_img',
+        aligned_feature_projection_mode='fc-1layer',
+        aligned_feature_projection_dim=args.aligned_feature_projection_dim)
+    model_teacher = models_mae_distill.__dict__[args.model_teacher](
+        img_size=args.input_size, embedding_distillation_func='L1',
+        aligned_blks_indices=args.aligned_blks_indices)
+    train_args = distill_args(args, '--profile', '--teacher_device', 'cpu', '--teacher_threads', str(teacher_threads),
+                              '--teacher_queue_depth', str(args.teacher_queue_depth))
+
+    results = {}
+    torch.set_num_threads(args.threads)
+    results['inline'] = run(args, None, model, model_teacher, train_args)
+    results['inline']['threads'] = args.threads
+
+    teacher_process = TeacherProcess(model_teacher, train_args)
+    torch.set_num_threads(args.threads - teacher_threads)
+    try:
+        results['pipelined'] = run(args, teacher_process, model, model_teacher, train_args)
+    finally:
+        teacher_process.close()
+    results['pipelined']['threads'] = '%d student + %d teacher' % (args.threads - teacher_threads, teacher_threads)
+
+    print('mode\tthreads\timages/s\tphases (ms)')
+    for mode, r in results.items():
+        print('{}\t{}\t{:.2f}\t{}'.format(mode, r['threads'], r['images_per_s'],
+                                          '  '.join('{} {:.1f}'.format(k, v) for k, v in r['phases_ms'].items())))
+    print('speedup: {:.2f}x'.format(results['pipelined']['images_per_s'] / results['inline']['images_per_s']))
+
+    if args.output_json:
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
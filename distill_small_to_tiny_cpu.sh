@@ -0,0 +1,29 @@
+#!/bin/bash
+# Multi-process data-parallel distillation on a many-core CPU box (gloo backend).
+# Every process is pinned to its own block of cores, see --cpu_threads.
+EXP_NAME=distilled_tiny_model_cpu
+SAVE_DIR="./work_dirs/${EXP_NAME}_e1/"
+PROCS=4
+
+python -m torch.distributed.launch \
+    --nproc_per_node=${PROCS} \
+    --use_env main_distill.py \
+    --output_dir ${SAVE_DIR} \
+    --log_dir ${SAVE_DIR} \
+    --device cpu \
+    --precision bf16 \
+    --no_pin_mem \
+    --num_workers 2 \
+    --batch_size 32 \
+    --accum_iter 4 \
+    --model mae_vit_tiny_patch16_dec512d2b \
+    --model_teacher mae_vit_small_patch16_dec512d8b \
+    --mask_ratio 0.75 \
+    --epochs 100 \
+    --blr 1.5e-4 --weight_decay 0.05 \
+    --teacher_model_path 'vit-s_CXR_0.3M_mae.pth' \
+    --student_reconstruction_target 'original_img' \
+    --aligned_blks_indices 8 \
+    --teacher_aligned_blks_indices 8 \
+    --embedding_distillation_func L1 \
+    --aligned_feature_projection_dim 192 384
@@ -0,0 +1,36 @@
+#!/bin/bash
+# Several tiny students distilled from one small teacher: one data pipeline and one
+# teacher forward per batch. Each student writes to ${SAVE_DIR}/<name>/.
+EXP_NAME=distilled_tiny_students
+SAVE_DIR="./work_dirs/${EXP_NAME}_e1/"
+GPUS=4
+
+mkdir -p ${SAVE_DIR}
+cat > ${SAVE_DIR}/students.json <<JSON
+[
+    {"name": "tiny_dec2b_blk8", "model": "mae_vit_tiny_patch16_dec512d2b",
+     "aligned_blks_indices": [8], "teacher_aligned_blks_indices": [8]},
+    {"name": "tiny_dec8b_blk8", "model": "mae_vit_tiny_patch16_dec512d8b",
+     "aligned_blks_indices": [8], "teacher_aligned_blks_indices": [8]},
+    {"name": "tiny_dec2b_blk5_mlp", "model": "mae_vit_tiny_patch16_dec512d2b",
+     "aligned_blks_indices": [5], "teacher_aligned_blks_indices": [5],
+     "aligned_feature_projection_mode": "mlp-1layer"}
+]
+JSON
+
+OMP_NUM_THREADS=1 python -m torch.distributed.launch \
+    --nproc_per_node=${GPUS} \
+    --use_env main_distill.py \
+    --output_dir ${SAVE_DIR} \
+    --log_dir ${SAVE_DIR} \
+    --students ${SAVE_DIR}/students.json \
+    --batch_size 32 \
+    --accum_iter 4 \
+    --model_teacher mae_vit_small_patch16_dec512d8b \
+    --mask_ratio 0.75 \
+    --epochs 100 \
+    --blr 1.5e-4 --weight_decay 0.05 \
+    --teacher_model_path 'vit-s_CXR_0.3M_mae.pth' \
+    --student_reconstruction_target 'original_img' \
+    --embedding_distillation_func L1 \
+    --aligned_feature_projection_dim 192 384
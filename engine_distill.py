@@ -1,100 +1,407 @@
-import math
-import sys
+import io
+import queue
+import time
+import traceback
+from collections import defaultdict, deque
 from typing import Iterable
 
 import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
 
 import util.misc as misc
 import util.lr_sched as lr_sched
+from util.profiler import StepProfiler, model_flops_per_image, tokens_per_image
+from util.quantization import feature_drift
+
+def prepare_images(samples, device, img_size, args):
+    """
+    The images of a loaded batch on device, at img_size, with --masks_per_image views of each.
+    """
+    imgs = samples[0] if isinstance(samples, list) else samples
+    imgs = imgs.to(device, non_blocking=True)
+
+    # with a resolution schedule the models may run below the loaded image size
+    if tuple(imgs.shape[-2:]) != tuple(img_size):
+        imgs = F.interpolate(imgs, size=img_size, mode='bicubic', align_corners=False, antialias=True)
+
+    # K independently masked views of each decoded image: the masks are drawn per sample
+    if args.masks_per_image > 1:
+        imgs = imgs.repeat_interleave(args.masks_per_image, dim=0)
+    return imgs
+
+
+def teacher_forward(model_teacher, imgs, device, args, precision=None):
+    """
+    (latents_teacher, mask, ids_restore, ids_keep, teacher_prediction) of one batch,
+    under precision (default: --precision).
+    """
+    # the int8 kernels take float32 inputs (see util/quantization.py)
+    if precision is None:
+        precision = 'fp32' if getattr(model_teacher, 'int8', None) else args.precision
+    with misc.autocast(device, precision), torch.no_grad():
+        latents_teacher, mask, ids_restore, ids_keep = model_teacher.forward_encoder_customized(imgs, args.mask_ratio)
+        teacher_prediction = model_teacher.forward_decoder(latents_teacher[-1], ids_restore)
+    return latents_teacher, mask, ids_restore, ids_keep, teacher_prediction
+
+
+@torch.no_grad()
+def compare_teachers(model_reference, model_teacher, batches, students, args):
+    """
+    Drift of model_teacher (e.g. int8) against model_reference, run in fp32, on CPU batches: per
+    aligned block and for the prediction, the relative L2 error and cosine of the teacher
+    outputs; per student, its distillation losses against either teacher (same masks);
+    and the mean teacher forward time of both (first batch excluded as warmup).
+    """
+    device = torch.device('cpu')
+    outputs, times = {}, {}
+    for key, model in (('reference', model_reference), ('teacher', model_teacher)):
+        outputs[key], elapsed = [], 0.
+        for i, imgs in enumerate(batches):
+            # the same masks for both teachers
+            with torch.random.fork_rng():
+                torch.manual_seed(args.seed + i)
+                start = time.perf_counter()
+                outputs[key].append(teacher_forward(model, imgs, device, args,
+                                                    precision='fp32' if key == 'reference' else None))
+                if i > 0 or len(batches) == 1:
+                    elapsed += time.perf_counter() - start
+        times[key] = elapsed / max(len(batches) - 1, 1) * 1000.
+
+    drift = defaultdict(lambda: defaultdict(float))
+    names = ['block%d' % i for i in (model_reference.aligned_blks_indices or [])] + ['final']
+    for (ref_latents, *_, ref_pred), (latents, *_, pred) in zip(outputs['reference'], outputs['teacher']):
+        for name, ref, x in zip(names, ref_latents, latents):
+            for k, v in feature_drift(ref, x).items():
+                drift[name][k] += v / len(batches)
+        for k, v in feature_drift(ref_pred, pred).items():
+            drift['prediction'][k] += v / len(batches)
+
+    losses = defaultdict(lambda: defaultdict(float))
+    for student in students:
+        model = student.model_without_ddp
+        if student.args.aligned_blks_indices is None:
+            continue
+        student_device = next(model.parameters()).device
+        was_training = model.training
+        model.eval()
+        for imgs, ref_outputs, outputs_ in zip(batches, outputs['reference'], outputs['teacher']):
+            for key, (latents, *rest) in (('reference', ref_outputs), ('teacher', outputs_)):
+                latents = [x.to(student_device) for x in latents]
+                mask, ids_restore, ids_keep, pred = [x.to(student_device) for x in rest]
+                with misc.autocast(student_device, args.precision):
+                    _, loss_distillation_embedding, _, _ = model(
+                        imgs.to(student_device), ids_keep, ids_restore, mask, pred,
+                        student.args.target_sum_weights, student.teacher_latents(latents))
+                losses[student.name or 'student'][key] += \
+                    sum(v.item() for v in loss_distillation_embedding.values()) / len(batches)
+        model.train(was_training)
+
+    return {'teacher_forward_ms': times, 'speedup': times['reference'] / times['teacher'],
+            'drift': {k: dict(v) for k, v in drift.items()},
+            'distillation_loss': {k: dict(v) for k, v in losses.items()}}
+
+
+def _teacher_worker(model_teacher, device, args, jobs, results):
+    if isinstance(model_teacher, bytes):
+        model_teacher = torch.load(io.BytesIO(model_teacher), map_location='cpu', weights_only=False)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    elif args.teacher_threads > 0:
+        torch.set_num_threads(args.teacher_threads)
+    model_teacher.to(device).eval()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        imgs, seed = job
+        try:
+            # the masks follow the RNG of the training process
+            torch.manual_seed(seed)
+            # follows the resolution schedule of the training process
+            model_teacher.set_img_size(imgs.shape[-1])
+            outputs = teacher_forward(model_teacher, imgs.to(device), device, args)
+            latents_teacher, *rest = outputs
+            # handed back through shared memory
+            results.put(([x.cpu() for x in latents_teacher], *[x.cpu() for x in rest]))
+        except Exception:
+            results.put(traceback.format_exc())
+
+
+class TeacherProcess(object):
+    """
+    Runs the teacher forward in its own process (on --teacher_device with --teacher_threads),
+    so that it overlaps with the student steps. pipeline() feeds it the batches of a data
+    loader up to --teacher_queue_depth batches ahead of the student; images and teacher
+    outputs are passed through shared memory. Each batch carries a seed drawn from the RNG of
+    the training process, so the masks depend on --seed and the rank and are restored on resume.
+    """
+
+    def __init__(self, model_teacher, args):
+        ctx = mp.get_context('spawn')
+        device = torch.device(args.teacher_device)
+        if device.type == 'cuda' and device.index is None:
+            # the GPU of this rank, not GPU 0 of every rank
+            device = torch.device('cuda', torch.cuda.current_device())
+        self.depth = args.teacher_queue_depth
+        self.jobs = ctx.Queue(maxsize=self.depth)
+        self.results = ctx.Queue(maxsize=self.depth)
+        if getattr(model_teacher, 'int8', None):
+            # packed int8 weights cannot be moved to shared memory: the process gets a serialized copy
+            buffer = io.BytesIO()
+            torch.save(model_teacher, buffer)
+            model_teacher = buffer.getvalue()
+        else:
+            model_teacher.share_memory()
+        self.process = ctx.Process(target=_teacher_worker,
+                                   args=(model_teacher, device, args, self.jobs, self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def _wait(self, fn, *args):
+        # a teacher process that died never answers: check it instead of blocking forever
+        while True:
+            try:
+                return fn(*args, timeout=10)
+            except (queue.Empty, queue.Full):
+                if not self.process.is_alive():
+                    raise RuntimeError('Teacher process exited with code %s' % self.process.exitcode)
+
+    def submit(self, imgs):
+        seed = int(torch.randint(2 ** 62, ()))
+        self._wait(self.jobs.put, (imgs, seed))
+
+    def get(self, device):
+        """
+        The teacher outputs of the oldest batch in flight, on device.
+        """
+        outputs = self._wait(self.results.get)
+        if isinstance(outputs, str):
+            raise RuntimeError('Teacher process failed:\n' + outputs)
+        latents_teacher, *rest = outputs
+        return ([x.to(device, non_blocking=True) for x in latents_teacher],
+                *[x.to(device, non_blocking=True) for x in rest])
+
+    def pipeline(self, data_loader, img_size, args):
+        return _TeacherPipeline(self, data_loader, img_size, args)
+
+    def close(self):
+        self.jobs.put(None)
+        self.process.join()
+
+
+class _TeacherPipeline(object):
+    """
+    Iterates (images, None) over a data loader, with the images already submitted to the
+    teacher process; TeacherProcess.get() returns their teacher outputs in the same order.
+    """
+
+    def __init__(self, teacher_process, data_loader, img_size, args):
+        self.teacher_process = teacher_process
+        self.data_loader = data_loader
+        self.img_size = img_size
+        self.args = args
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        in_flight = deque()
+        batches = iter(self.data_loader)
+
+        def submit():
+            try:
+                samples, _ = next(batches)
+            except StopIteration:
+                return
+            imgs = prepare_images(samples, torch.device('cpu'), self.img_size, self.args)
+            self.teacher_process.submit(imgs)
+            in_flight.append(imgs)
+
+        for _ in range(self.teacher_process.depth):
+            submit()
+        try:
+            while in_flight:
+                imgs = in_flight.popleft()
+                # the next batch goes to the teacher before the student waits for this one
+                submit()
+                yield imgs, None
+        finally:
+            # an interrupted epoch leaves no stale results for the next one
+            if self.teacher_process.process.is_alive():
+                for _ in range(len(in_flight)):
+                    self.teacher_process._wait(self.teacher_process.results.get)
+
+
+def select_teacher_latents(latents_teacher, teacher_latent_indices):
+    """The teacher latents at teacher_latent_indices (None: all) and the final one."""
+    if teacher_latent_indices is None:
+        return latents_teacher
+    return [latents_teacher[i] for i in teacher_latent_indices] + [latents_teacher[-1]]
+
+
+class DistillStudent(object):
+    """
+    One student of a distillation run: its model, optimizer, loss scaler, args (lr schedule,
+    output and log dirs) and log writer. teacher_latent_indices selects the teacher latents
+    it is aligned to out of the ones the teacher returns (None: all of them).
+    """
+
+    def __init__(self, model, optimizer, loss_scaler, args, name='', log_writer=None, teacher_latent_indices=None):
+        self.model = model
+        self.optimizer = optimizer
+        self.loss_scaler = loss_scaler
+        self.args = args
+        self.name = name
+        self.log_writer = log_writer
+        self.teacher_latent_indices = teacher_latent_indices
+        self.model_without_ddp = model.module if hasattr(model, 'module') else model
+        # the meters of a named student are prefixed in the shared logger
+        self.prefix = name + '/' if name else ''
+
+    def teacher_latents(self, latents_teacher):
+        return select_teacher_latents(latents_teacher, self.teacher_latent_indices)
+
 
 def train_one_epoch(model: torch.nn.Module, model_teacher: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler,
                     log_writer=None,
-                    args=None):
-    
-    model.train(True)
+                    args=None, step_checkpointer=None, teacher_process=None):
+    student = DistillStudent(model, optimizer, loss_scaler, args, log_writer=log_writer)
+    return train_students_one_epoch([student], model_teacher, data_loader, device, epoch, args,
+                                    step_checkpointer=step_checkpointer, teacher_process=teacher_process)[0]
+
+
+def train_students_one_epoch(students, model_teacher: torch.nn.Module, data_loader: Iterable,
+                             device: torch.device, epoch: int, args=None, step_checkpointer=None,
+                             teacher_process=None):
+    """
+    One epoch of distilling every student from the same teacher forward: each batch is loaded
+    and run through the teacher once, then each student takes its own forward, backward and
+    optimizer step. With a TeacherProcess the teacher forward runs there, ahead of the students.
+    Returns the train stats of each student.
+    """
+    for student in students:
+        student.model.train(True)
+        student.optimizer.zero_grad()
+        if student.log_writer is not None:
+            print('log_dir: {}'.format(student.log_writer.log_dir))
     model_teacher.eval()
-    
+
     metric_logger = misc.MetricLogger(delimiter="  ")
-    metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
-    
+    for student in students:
+        metric_logger.add_meter(student.prefix + 'lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+        metric_logger.require_finite(student.prefix + 'loss')
+
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 20
 
     accum_iter = args.accum_iter
+    print(len(data_loader))
 
-    optimizer.zero_grad()
+    # a run resumed from a mid-epoch checkpoint starts its first epoch at start_step
+    start_step = args.start_step if epoch == args.start_epoch else 0
+    num_steps = start_step + len(data_loader)
+    if step_checkpointer is not None:
+        step_checkpointer.start_epoch(epoch, num_steps)
 
-    if log_writer is not None:
-        print('log_dir: {}'.format(log_writer.log_dir))
-    print(len(data_loader))
-    
-    for data_iter_step, (samples, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    model_teacher_without_ddp = model_teacher.module if hasattr(model_teacher, 'module') else model_teacher
+    train_flops = [model_flops_per_image(s.model_without_ddp, args.mask_ratio) for s in students]
+    profiler = StepProfiler(args, device, epoch,
+                            train_flops_per_image=None if None in train_flops else sum(train_flops),
+                            frozen_flops_per_image=model_flops_per_image(model_teacher_without_ddp, args.mask_ratio),
+                            tokens_per_image=tokens_per_image(students[0].model_without_ddp, args.mask_ratio))
 
-        if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+    tb_metrics = misc.ScalarAccumulator()
+    img_size = model_teacher_without_ddp.patch_embed.img_size
+    if teacher_process is not None:
+        data_loader = teacher_process.pipeline(data_loader, img_size, args)
 
-        if isinstance(samples, list):
-            imgs = samples[0].to(device, non_blocking=True)
-            heatmaps = samples[1].to(device, non_blocking=True)
+    for data_iter_step, (samples, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header),
+                                                  start=start_step):
 
-        else:
-            imgs = samples.to(device, non_blocking=True)
-            heatmaps = None
+        if data_iter_step % accum_iter == 0:
+            for student in students:
+                lr_sched.adjust_learning_rate(student.optimizer, data_iter_step / num_steps + epoch, student.args)
+
+        with profiler.phase('to_device'):
+            if teacher_process is None:
+                imgs = prepare_images(samples, device, img_size, args)
+            else:
+                imgs = samples.to(device, non_blocking=True)
 
-        with torch.cuda.amp.autocast():
-            
-            with torch.no_grad():
-                latents_teacher, mask, ids_restore, ids_keep = \
-                    model_teacher.module.forward_encoder_customized(imgs, args.mask_ratio)
-                teacher_prediction = model_teacher.module.forward_decoder(latents_teacher[-1], ids_restore)  
-            
-            loss, loss_distillation_embedding, _, _ = model(imgs, ids_keep, ids_restore, mask, teacher_prediction,
-                                                            args.target_sum_weights, latents_teacher)
+        with profiler.phase('teacher'):
+            if teacher_process is None:
+                latents_teacher, mask, ids_restore, ids_keep, teacher_prediction = \
+                    teacher_forward(model_teacher_without_ddp, imgs, device, args)
+            else:
+                # only the wait for the teacher process: its forward overlaps with the student steps
+                latents_teacher, mask, ids_restore, ids_keep, teacher_prediction = teacher_process.get(device)
 
-            loss_value = loss.item()
-            for loss_k, loss_v in loss_distillation_embedding.items():
-                loss += loss_v
+        for student in students:
+            model, optimizer, loss_scaler = student.model, student.optimizer, student.loss_scaler
+            with misc.autocast(device, args.precision), profiler.phase('forward'):
+                loss, loss_distillation_embedding, _, _ = model(imgs, ids_keep, ids_restore, mask,
+                                                                teacher_prediction, student.args.target_sum_weights,
+                                                                student.teacher_latents(latents_teacher))
 
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+                loss_value = loss.detach().clone()
+                for loss_k, loss_v in loss_distillation_embedding.items():
+                    loss += loss_v
 
-        loss /= accum_iter
-        loss_scaler(loss, optimizer, parameters=model.parameters(),
-                    update_grad=(data_iter_step + 1) % accum_iter == 0)
+            loss /= accum_iter
+            # under DDP the gradient all-reduce overlaps with (and is timed in) backward
+            with profiler.phase('backward'):
+                loss_scaler.backward(loss)
+            with profiler.phase('optimizer'):
+                loss_scaler.step(optimizer, parameters=model.parameters(),
+                                 update_grad=(data_iter_step + 1) % accum_iter == 0)
 
-        if (data_iter_step + 1) % accum_iter == 0:
-            optimizer.zero_grad()
+            if (data_iter_step + 1) % accum_iter == 0:
+                optimizer.zero_grad()
 
-        torch.cuda.synchronize()
+            # non-finite losses are detected lazily by the logger at print time
+            metric_logger.update(**{student.prefix + 'loss': loss_value,
+                                    student.prefix + 'lr': optimizer.param_groups[0]["lr"]})
 
-        metric_logger.update(loss=loss_value)
+            if student.args.log_dir is not None and (data_iter_step + 1) % accum_iter == 0:
+                metrics = {student.prefix + 'train_loss': loss_value}
+                if student.args.aligned_blks_indices is not None:
+                    metrics[student.prefix + 'train_loss_total'] = loss.detach()
+                    for loss_k, loss_v in loss_distillation_embedding.items():
+                        metrics[student.prefix + f'distillation_loss/{loss_k}'] = loss_v.detach()
+                tb_metrics.update(metrics)
 
-        lr = optimizer.param_groups[0]["lr"]
-        metric_logger.update(lr=lr)
+        # the metrics of all students since the last log point are averaged over steps and
+        # processes with a single all-reduce, every print_freq steps only
+        if tb_metrics.sums and ((data_iter_step + 1) % print_freq == 0 or data_iter_step + 1 == num_steps):
+            with profiler.phase('sync'):
+                metrics = tb_metrics.flush()
 
-        loss_value_reduce = misc.all_reduce_mean(loss_value)
+            epoch_1000x = int((data_iter_step / num_steps + epoch) * 1000)
+            for student in students:
+                if student.log_writer is None:
+                    continue
+                student.log_writer.add_scalar('lr', student.optimizer.param_groups[0]["lr"], epoch_1000x)
+                for key, value in metrics.items():
+                    if key.startswith(student.prefix):
+                        student.log_writer.add_scalar(key[len(student.prefix):], value, epoch_1000x)
 
-        if args.aligned_blks_indices is not None:
-            loss_total = loss.item()
-            loss_total_value_reduce = misc.all_reduce_mean(loss_total)
+        if step_checkpointer is not None:
+            step_checkpointer.step(data_iter_step)
 
-        if args.aligned_blks_indices is not None:
-            for loss_k, loss_v in loss_distillation_embedding.items():
-                loss_distillation_embedding[loss_k] = misc.all_reduce_mean(loss_v)
+        profiler.step(imgs.shape[0], metric_logger)
 
-        if log_writer is not None and (data_iter_step + 1) % accum_iter == 0:
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
-            log_writer.add_scalar('train_loss', loss_value_reduce, epoch_1000x)
-            log_writer.add_scalar('lr', lr, epoch_1000x)
-            if args.aligned_blks_indices is not None:
-                log_writer.add_scalar('train_loss_total', loss_total_value_reduce, epoch_1000x)
-                for key, value in loss_distillation_embedding.items():
-                    log_writer.add_scalar(f'distillation_loss/{key}', value, epoch_1000x)
+    profiler.close(metric_logger)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
\ No newline at end of file
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    # each student gets its own meters (without prefix) and the shared ones (throughput, phase times)
+    own = {k for student in students if student.prefix for k in stats if k.startswith(student.prefix)}
+    shared = {k: v for k, v in stats.items() if k not in own}
+    return [{**shared, **{k[len(s.prefix):]: v for k, v in stats.items() if s.prefix and k.startswith(s.prefix)}}
+            for s in students]
@@ -9,28 +9,35 @@
 # BEiT: https://github.com/microsoft/unilm/tree/master/beit
 # --------------------------------------------------------
 
-import math
-import sys
 from typing import Iterable, Optional
 
+import queue
+import traceback
+
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 
 from timm.data import Mixup
 from timm.utils import accuracy
 import util.misc as misc
 import util.lr_sched as lr_sched
-from sklearn.metrics._ranking import roc_auc_score
+from util.profiler import StepProfiler, model_flops_per_image, tokens_per_image
+from util.metrics import multilabel_auroc, StreamingAUROC
+from util.sampler import DistributedEvalSampler
 from libauc import losses
+from torchvision import models
+from models import models_vit
 
 def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0,
                     mixup_fn: Optional[Mixup] = None, log_writer=None,
-                    args=None, last_activation=None):
+                    args=None, last_activation=None, step_checkpointer=None):
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
+    metric_logger.require_finite('loss')
     header = 'Epoch: [{}]'.format(epoch)
     print_freq = 20
 
@@ -41,43 +48,54 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    # a run resumed from a mid-epoch checkpoint starts its first epoch at start_step
+    start_step = args.start_step if epoch == args.start_epoch else 0
+    num_steps = start_step + len(data_loader)
+    if step_checkpointer is not None:
+        step_checkpointer.start_epoch(epoch, num_steps)
+
+    model_without_ddp = model.module if hasattr(model, 'module') else model
+    profiler = StepProfiler(args, device, epoch, train_flops_per_image=model_flops_per_image(model_without_ddp),
+                            tokens_per_image=tokens_per_image(model_without_ddp))
+    tb_metrics = misc.ScalarAccumulator()
+
+    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header),
+                                                        start=start_step):
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+            lr_sched.adjust_learning_rate(optimizer, data_iter_step / num_steps + epoch, args)
 
-        samples = samples.to(device, non_blocking=True)
-        targets = targets.to(device, non_blocking=True)
+        with profiler.phase('to_device'):
+            samples = samples.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
 
-        if mixup_fn is not None:
-            samples, targets = mixup_fn(samples, targets)
+            if mixup_fn is not None:
+                samples, targets = mixup_fn(samples, targets)
 
         if last_activation is not None:
             if last_activation == 'sigmoid':
                 last_activation = torch.nn.Sigmoid()
 
-        with torch.cuda.amp.autocast():
+        with misc.autocast(device, args.precision), profiler.phase('forward'):
             outputs = model(samples)
             if last_activation is not None:
                 outputs = last_activation(outputs)
             loss = criterion(outputs, targets)
 
-        loss_value = loss.item()
-
-        if not math.isfinite(loss_value):
-            print("Loss is {}, stopping training".format(loss_value))
-            sys.exit(1)
+        # non-finite losses are detected lazily by the logger at print time
+        loss_value = loss.detach().clone()
 
         loss /= accum_iter
-        loss_scaler(loss, optimizer, clip_grad=max_norm,
-                    parameters=model.parameters(), create_graph=False,
-                    update_grad=(data_iter_step + 1) % accum_iter == 0)
+        # under DDP the gradient all-reduce overlaps with (and is timed in) backward
+        with profiler.phase('backward'):
+            loss_scaler.backward(loss, create_graph=False)
+        with profiler.phase('optimizer'):
+            loss_scaler.step(optimizer, clip_grad=max_norm, parameters=model.parameters(),
+                             update_grad=(data_iter_step + 1) % accum_iter == 0)
         if (data_iter_step + 1) % accum_iter == 0:
             optimizer.zero_grad()
 
-        torch.cuda.synchronize()
-
         metric_logger.update(loss=loss_value)
         min_lr = 10.
         max_lr = 0.
@@ -87,14 +105,26 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
 
         metric_logger.update(lr=max_lr)
 
-        loss_value_reduce = misc.all_reduce_mean(loss_value)
-        if log_writer is not None and (data_iter_step + 1) % accum_iter == 0:
-            """ We use epoch_1000x as the x-axis in tensorboard.
-            This calibrates different curves when batch size changes.
-            """
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
-            log_writer.add_scalar('loss', loss_value_reduce, epoch_1000x)
-            log_writer.add_scalar('lr', max_lr, epoch_1000x)
+        if args.log_dir is not None and (data_iter_step + 1) % accum_iter == 0:
+            tb_metrics.update({'loss': loss_value})
+        # averaged over the steps since the last log point and over processes, every print_freq steps only
+        if tb_metrics.sums and ((data_iter_step + 1) % print_freq == 0 or data_iter_step + 1 == num_steps):
+            with profiler.phase('sync'):
+                loss_value_reduce = tb_metrics.flush()['loss']
+            if log_writer is not None:
+                """ We use epoch_1000x as the x-axis in tensorboard.
+                This calibrates different curves when batch size changes.
+                """
+                epoch_1000x = int((data_iter_step / num_steps + epoch) * 1000)
+                log_writer.add_scalar('loss', loss_value_reduce, epoch_1000x)
+                log_writer.add_scalar('lr', max_lr, epoch_1000x)
+
+        if step_checkpointer is not None:
+            step_checkpointer.step(data_iter_step)
+
+        profiler.step(samples.shape[0], metric_logger)
+
+    profiler.close(metric_logger)
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -119,7 +149,7 @@ def evaluate(data_loader, model, device):
         target = target.to(device, non_blocking=True)
 
         # compute output
-        with torch.cuda.amp.autocast():
+        with misc.autocast(device):
             output = model(images)
             loss = criterion(output, target)
 
@@ -138,13 +168,9 @@ def evaluate(data_loader, model, device):
 
 
 def computeAUROC(dataGT, dataPRED, classCount):
-    outAUROC = []
-    # print(dataGT.shape, dataPRED.shape)
-    for i in range(classCount):
-        try:
-            outAUROC.append(roc_auc_score(dataGT[:, i], dataPRED[:, i]))
-        except:
-            outAUROC.append(0.)
+    """AUROC of every class in one vectorized rank-based pass, 0. for classes with a single label"""
+    outAUROC = multilabel_auroc(dataGT[:, :classCount], dataPRED[:, :classCount])
+    outAUROC = torch.nan_to_num(outAUROC, nan=0.).tolist()
     print(outAUROC)
     return outAUROC
 
@@ -173,7 +199,15 @@ def evaluate_medical(data_loader, model, device, args):
     model.eval()
     outputs = []
     targets = []
-    
+    num_classes = args.nb_classes
+    sharded = isinstance(data_loader.sampler, DistributedEvalSampler)
+
+    # with --auroc_bins the predictions are folded into per-class histograms instead of being kept
+    streaming_auroc = None
+    if args.auroc_bins > 0:
+        streaming_auroc = StreamingAUROC(num_classes, args.auroc_bins, device=device)
+        metric_logger.add_meter('auc_running', misc.SmoothedValue(window_size=1, fmt='{value:.4f}'))
+
     for batch in metric_logger.log_every(data_loader, 10, header):
         images = batch[0]
         target = batch[-1]
@@ -181,22 +215,38 @@ def evaluate_medical(data_loader, model, device, args):
         target = target.to(device, non_blocking=True)
 
         # compute output
-        with torch.cuda.amp.autocast():
+        with misc.autocast(device, args.precision):
             output = model(images)
             loss = criterion(output, target)
 
-        outputs.append(output)
-        targets.append(target)
-
-        metric_logger.update(loss=loss.item())
-
-    num_classes = args.nb_classes
+        if streaming_auroc is not None:
+            streaming_auroc.update(target, output.float().sigmoid())
+            metric_logger.update(auc_running=streaming_auroc.compute().nanmean())
+        else:
+            outputs.append(output)
+            targets.append(target)
+
+        metric_logger.update(loss=loss)
+
+    if streaming_auroc is not None:
+        metric_logger.meters.pop('auc_running')
+        if sharded:
+            streaming_auroc.synchronize_between_processes()
+        auc_each_class = torch.nan_to_num(streaming_auroc.compute(), nan=0.).tolist()
+        print(auc_each_class)
+        print('Histogram AUROC error bound: {:.2e}'.format(streaming_auroc.error_bound()))
+    else:
+        outputs = torch.cat(outputs, dim=0).float()
+        targets = torch.cat(targets, dim=0).float()
+        if sharded:
+            # every process evaluated its own shard: gather predictions and targets in one collective
+            gathered = misc.all_gather_sharded(torch.cat([outputs, targets], dim=1), len(data_loader.dataset))
+            outputs, targets = gathered.split([outputs.shape[1], targets.shape[1]], dim=1)
+        outputs = outputs.sigmoid()
 
-    outputs = torch.cat(outputs, dim=0).sigmoid().cpu().numpy()
-    targets = torch.cat(targets, dim=0).cpu().numpy()
+        print(targets.shape, outputs.shape)
+        auc_each_class = computeAUROC(targets, outputs, num_classes)
 
-    print(targets.shape, outputs.shape)
-    auc_each_class = computeAUROC(targets, outputs, num_classes)
     auc_each_class_array = np.array(auc_each_class)
     missing_classes_index = np.where(auc_each_class_array == 0)[0]
     if missing_classes_index.shape[0] > 0:
@@ -208,4 +258,102 @@ def evaluate_medical(data_loader, model, device, args):
 
     print('Loss {losses.global_avg:.3f}'.format(losses=metric_logger.loss))
     return {**{k: meter.global_avg for k, meter in metric_logger.meters.items()},
-            **{'auc_avg': auc_avg, 'auc_each_class': auc_each_class}}
\ No newline at end of file
+            **{'auc_avg': auc_avg, 'auc_each_class': auc_each_class}}
+
+
+def _async_eval_worker(args, dataset_val, jobs, results):
+    device = torch.device(args.async_eval_device)
+    if device.type == 'cpu' and args.async_eval_threads > 0:
+        torch.set_num_threads(args.async_eval_threads)
+    misc.setup_for_distributed(is_master=True)
+
+    if 'vit' in args.model:
+        model = models_vit.__dict__[args.model](
+            img_size=args.input_size,
+            num_classes=args.nb_classes,
+            drop_rate=args.vit_dropout_rate,
+            drop_path_rate=args.drop_path,
+            global_pool=args.global_pool,
+        )
+    else:
+        model = models.__dict__[args.model](num_classes=args.nb_classes)
+    model.to(device)
+
+    # the cached eval set lives in shared memory, so no loader workers are needed once it is filled
+    data_loader_val = torch.utils.data.DataLoader(
+        dataset_val, sampler=torch.utils.data.SequentialSampler(dataset_val),
+        batch_size=args.batch_size,
+        num_workers=0,
+        drop_last=False
+    )
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, checkpoint_path, train_stats = job
+        try:
+            checkpoint = torch.load(checkpoint_path, map_location='cpu')
+            model.load_state_dict(checkpoint['model'])
+            test_stats = evaluate_medical(data_loader_val, model, device, args)
+            results.put((epoch, train_stats, test_stats))
+        except Exception:
+            print('Evaluation of {} failed:\n{}'.format(checkpoint_path, traceback.format_exc()))
+            results.put((epoch, train_stats, None))
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluates saved checkpoints in a separate process (on spare CPU cores or a spare GPU,
+    see --async_eval_device) so that training continues while the val set is evaluated.
+    Results are returned by poll() as (epoch, train_stats, test_stats) tuples.
+    """
+
+    def __init__(self, args, dataset_val):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        # submit() may run on the checkpoint writer thread: each counter is only written by one thread
+        self.submitted = 0
+        self.received = 0
+        # daemonic so that a crashed training run never waits on the evaluator
+        self.process = ctx.Process(target=_async_eval_worker, args=(args, dataset_val, self.jobs, self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, checkpoint_path, epoch, train_stats):
+        self.jobs.put((epoch, str(checkpoint_path), train_stats))
+        self.submitted += 1
+
+    @property
+    def pending(self):
+        return self.submitted - self.received
+
+    def poll(self):
+        """
+        Results of the evaluations that finished since the last call, without waiting.
+        """
+        finished = []
+        while self.pending > 0:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+            self.received += 1
+        return finished
+
+    def close(self):
+        """
+        Wait for all submitted checkpoints to be evaluated and stop the evaluator.
+        """
+        finished = []
+        while self.pending > 0 and self.process.is_alive():
+            try:
+                finished.append(self.results.get(timeout=10))
+                self.received += 1
+            except queue.Empty:
+                continue
+        finished += self.poll()
+        self.jobs.put(None)
+        self.process.join()
+        return finished
@@ -0,0 +1,83 @@
+# --------------------------------------------------------
+# Export the weights of a distilled (MaskedAutoencoderViT) or fine-tuned (VisionTransformer)
+# checkpoint as a slim safetensors file in models_vit.VisionTransformer key layout, at the
+# target resolution. Decoder, projection heads, optimizer state and args are dropped.
+# --------------------------------------------------------
+
+import argparse
+import os
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import save_file
+
+import util.misc as misc
+from util.pos_embed import interpolate_pos_embed
+
+from models import models_vit
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Export encoder weights as safetensors', add_help=False)
+    parser.add_argument('--checkpoint', required=True, type=str,
+                        help='checkpoint written by main_distill.py or main_med_finetune.py')
+    parser.add_argument('--output', required=True, type=str,
+                        help='output .safetensors file')
+    parser.add_argument('--model', default='vit_tiny_patch16', type=str, metavar='MODEL',
+                        help='models_vit model the weights are exported for')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='target image size, pos_embed is interpolated to it')
+    parser.add_argument('--nb_classes', default=14, type=int,
+                        help='classes of the target model; the head is kept only if it matches')
+    parser.add_argument('--global_pool', action='store_true')
+    parser.set_defaults(global_pool=True)
+    parser.add_argument('--cls_token', action='store_false', dest='global_pool',
+                        help='Use class token instead of global pool for classification')
+    parser.add_argument('--dtype', default='fp16', type=str, choices=['fp16', 'fp32'])
+    return parser
+
+
+def export_encoder(checkpoint_model, model, dtype):
+    """
+    The entries of checkpoint_model that model has with the same shape, after pos_embed
+    has been interpolated to the model's resolution.
+    """
+    interpolate_pos_embed(model, checkpoint_model)
+    state_dict = model.state_dict()
+    encoder = OrderedDict()
+    for k, v in checkpoint_model.items():
+        if k in state_dict and v.shape == state_dict[k].shape:
+            encoder[k] = v.to(dtype).contiguous()
+    return encoder
+
+
+def main(args):
+    checkpoint_model = misc.load_state_dict_file(args.checkpoint)
+    model = models_vit.__dict__[args.model](
+        img_size=args.input_size,
+        num_classes=args.nb_classes,
+        global_pool=args.global_pool,
+    )
+    dtype = torch.float16 if args.dtype == 'fp16' else torch.float32
+    encoder = export_encoder(checkpoint_model, model, dtype)
+
+    dropped = [k for k in checkpoint_model if k not in encoder]
+    missing = [k for k in model.state_dict() if k not in encoder]
+    print("Exported %d tensors, dropped %d (%s)" % (len(encoder), len(dropped), ', '.join(dropped[:8]) + (', ...' if len(dropped) > 8 else '')))
+    print("Not in the export, initialized by the model: %s" % missing)
+
+    metadata = {
+        'model': args.model,
+        'input_size': str(args.input_size),
+        'global_pool': str(args.global_pool),
+        'source': os.path.basename(args.checkpoint),
+    }
+    save_file(encoder, args.output, metadata=metadata)
+    print("Saved %s (%.1f MB, %s: %.1f MB)" % (args.output, os.path.getsize(args.output) / 2 ** 20,
+                                               args.checkpoint, os.path.getsize(args.checkpoint) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import datetime
 import json
 import numpy as np
@@ -19,16 +20,25 @@ import timm.optim.optim_factory as optim_factory
 import util.misc as misc
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
 from util.dataloader_medical import CheXpert, ChestX_ray14
+from util.quantization import block_linear_names, quantize_blocks
+from util.sampler import ResumableDistributedSampler
 
 import models.models_mae_distill as models_mae_distill
 
-from engine_distill import train_one_epoch
+from engine_distill import DistillStudent, TeacherProcess, compare_teachers, prepare_images, select_teacher_latents, \
+    teacher_forward, train_students_one_epoch
+
+# args a --students entry may set for its student
+STUDENT_ARGS = ['model', 'norm_pix_loss', 'lr', 'blr', 'min_lr', 'weight_decay', 'resume', 'student_init_weights',
+                'load_weights_keywords', 'freeze_keywords', 'aligned_blks_indices', 'teacher_aligned_blks_indices',
+                'embedding_distillation_func', 'student_reconstruction_target', 'distillation_disentangled_target',
+                'target_sum_weights', 'aligned_feature_projection_mode', 'aligned_feature_projection_dim']
 
 def get_args_parser():
 
     parser = argparse.ArgumentParser('MAE Knowledge Distillation (pre-training)', add_help=False)
     parser.add_argument('--batch_size', default=64, type=int,
-                        help='Batch size per GPU (effective batch size is batch_size * accum_iter * # gpus')
+                        help='Batch size per GPU (effective batch size is batch_size * masks_per_image * accum_iter * # gpus')
     parser.add_argument('--epochs', default=400, type=int)
     parser.add_argument('--accum_iter', default=1, type=int,
                         help='Accumulate gradient iterations (for increasing the effective batch size under memory constraints)')
@@ -40,6 +50,15 @@ def get_args_parser():
                         help='images input size')
     parser.add_argument('--mask_ratio', default=0.75, type=float,
                         help='Masking ratio (percentage of removed patches).')
+    parser.add_argument('--resolution_schedule', nargs='+', type=str, default=None,
+                        help='progressive resolution as EPOCH:SIZE entries, e.g. 0:112 30:160 60:224; images are '
+                             'loaded at --input_size and resized on the device, the pos embeds of teacher and '
+                             'students are regenerated. The last size must be --input_size')
+    parser.add_argument('--resolution_scale_batch', action='store_true',
+                        help='scale the batch size per process by (input_size / size)^2 at lower resolutions')
+    parser.add_argument('--masks_per_image', default=1, type=int,
+                        help='independently masked views of each loaded image, expanded on the device; '
+                             'the effective batch size (and the lr derived from --blr) grows by this factor')
     parser.add_argument('--norm_pix_loss', action='store_true',
                         help='Use (per-patch) normalized pixels as targets for computing loss')
     parser.set_defaults(norm_pix_loss=False)
@@ -55,19 +74,45 @@ def get_args_parser():
                         help='lower lr bound for cyclic schedulers that hit 0')
     parser.add_argument('--warmup_epochs', type=int, default=20, metavar='N',
                         help='epochs to warmup LR')
+    parser.add_argument('--opt_impl', default='fused', type=str, choices=['default', 'foreach', 'fused'],
+                        help='AdamW implementation (fused falls back to foreach where unsupported)')
+    parser.add_argument('--shard_optimizer', action='store_true', default=False,
+                        help='shard the AdamW states across the distributed processes (ZeRO stage 1); '
+                             'checkpoints hold the consolidated states and load with or without it')
 
     # Dataset parameters
     parser.add_argument('--data_path', default='/datasets01/imagenet_full_size/061417/', type=str,
                         help='dataset path')
     parser.add_argument('--output_dir', default='./output_dir',
                         help='path where to save, empty for no saving')
+    parser.add_argument('--async_save', action='store_true',
+                        help='Write checkpoints from a background thread')
+    parser.add_argument('--no_async_save', action='store_false', dest='async_save')
+    parser.set_defaults(async_save=True)
+    parser.add_argument('--keep_last_k', default=0, type=int,
+                        help='keep only the last K checkpoints on disk (0: keep all); needs --async_save')
     parser.add_argument('--log_dir', default='./output_dir',
                         help='path where to tensorboard log')
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--precision', default='fp16', type=str, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision; fp16 uses loss scaling on CUDA, bf16 also works on CPU')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='time the phases of every training step and report images/s, tokens/s and MFU')
+    parser.add_argument('--profile_trace_steps', default=0, type=int,
+                        help='write a torch.profiler trace of this many steps of the first epoch to log_dir/trace')
+    parser.add_argument('--profile_trace_wait', default=10, type=int,
+                        help='steps to skip before the traced ones')
+    parser.add_argument('--peak_tflops', default=0, type=float,
+                        help='peak TFLOPS of one device for MFU (0: known GPUs only)')
     parser.add_argument('--resume', default='', help='resume from checkpoint')
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N', help='start epoch')
+    parser.add_argument('--start_step', default=0, type=int, metavar='N',
+                        help='iteration to start the start epoch at (set when resuming a mid-epoch checkpoint)')
+    parser.add_argument('--ckpt_interval_minutes', default=0, type=float,
+                        help='also write output_dir/checkpoint-last.pth about every this many minutes '
+                             'within an epoch, resumable with --resume (0: off)')
     parser.add_argument('--num_workers', default=10, type=int)
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
@@ -81,6 +126,11 @@ def get_args_parser():
     parser.add_argument('--dist_on_itp', action='store_true')
     parser.add_argument('--dist_url', default='env://',
                         help='url used to set up distributed training')
+    parser.add_argument('--ddp_find_unused_parameters', action='store_true', default=False,
+                        help='wrap the students in DDP with find_unused_parameters instead of a static graph '
+                             'with gradients as bucket views (slower backward, for comparison)')
+    parser.add_argument('--cpu_threads', default=0, type=int,
+                        help='intra-op threads per process with --device cpu (0: split the cores evenly between local processes)')
     parser.add_argument('--fixed_lr', action='store_true', default=False)
 
     # Knowledge distillation parameters
@@ -109,10 +159,220 @@ def get_args_parser():
                         help=' the mode of the projection head for aligned features')
     parser.add_argument('--aligned_feature_projection_dim', nargs='+', type=int, default=None,
                         help='the dimensions of the input and output of the projection head for aligned features')
+    parser.add_argument('--teacher_process', action='store_true', default=False,
+                        help='run the teacher forward in a separate process per rank, pipelined with the students')
+    parser.add_argument('--teacher_device', default=None, type=str,
+                        help='device of the teacher process (default: --device)')
+    parser.add_argument('--teacher_threads', default=0, type=int,
+                        help='intra-op threads of the teacher process on CPU (0: torch default)')
+    parser.add_argument('--teacher_queue_depth', default=2, type=int,
+                        help='batches the teacher process may run ahead of the students')
+    parser.add_argument('--teacher_int8', default=None, type=str, choices=['dynamic', 'static'],
+                        help='int8-quantize the linears of the teacher blocks (CPU teacher only): dynamic (weights) '
+                             'or static (weights and activations, calibrated on --teacher_int8_calib_batches)')
+    parser.add_argument('--teacher_int8_calib_batches', default=8, type=int,
+                        help='batches for the static calibration and the drift report against the fp32 teacher')
+    parser.add_argument('--students', default=None, type=str,
+                        help='JSON file with a list of student configs ({"name": ..., <student args>}), '
+                             'distilled together from one data pipeline and one teacher forward per batch; '
+                             'each student writes to output_dir/<name> and log_dir/<name>')
 
     return parser
 
+def quantize_teacher(model_teacher, data_loader, students, args):
+    """
+    Quantize the teacher in place with --teacher_int8, calibrated on the first
+    --teacher_int8_calib_batches batches, and report its drift from the fp32 teacher
+    on the same batches (printed and written to output_dir/teacher_int8_report.json).
+    """
+    teacher_device = args.teacher_device if args.teacher_process else args.device
+    assert torch.device(teacher_device).type == 'cpu', \
+        '--teacher_int8 needs a CPU teacher (--device cpu, or --teacher_process with --teacher_device cpu)'
+    assert args.teacher_int8_calib_batches > 0, '--teacher_int8_calib_batches must be positive'
+    batches = []
+    for samples, _ in data_loader:
+        batches.append(prepare_images(samples, torch.device('cpu'), model_teacher.patch_embed.img_size, args))
+        if len(batches) == args.teacher_int8_calib_batches:
+            break
+    model_reference = copy.deepcopy(model_teacher).cpu().eval()
+
+    def calibrate(model):
+        # the observers see the float32 activations the int8 kernels will get
+        for imgs in batches:
+            teacher_forward(model, imgs, torch.device('cpu'), args, precision='fp32')
+    quantize_blocks(model_teacher, args.teacher_int8, calibrate_fn=calibrate)
+    print("Teacher quantized to int8 (%s): %d block linears" % (args.teacher_int8,
+                                                                 len(block_linear_names(model_reference))))
+
+    report = compare_teachers(model_reference, model_teacher, batches, students, args)
+    del model_reference
+    print("Teacher forward: fp32 %.1f ms, int8 %.1f ms per batch (%.2fx)" % (
+        report['teacher_forward_ms']['reference'], report['teacher_forward_ms']['teacher'], report['speedup']))
+    for name, drift in report['drift'].items():
+        print("Teacher int8 drift %s: relative L2 %.4f, cosine %.5f" % (name, drift['rel_l2'], drift['cosine']))
+    for name, losses in report['distillation_loss'].items():
+        print("Distillation loss of %s: fp32 teacher %.5f, int8 teacher %.5f (%+.2f%%)" % (
+            name, losses['reference'], losses['teacher'], (losses['teacher'] / losses['reference'] - 1) * 100))
+    if args.output_dir and misc.is_main_process():
+        with open(os.path.join(args.output_dir, "teacher_int8_report.json"), mode="w", encoding="utf-8") as f:
+            json.dump({'mode': args.teacher_int8, 'num_batches': len(batches), **report}, f, indent=2)
+
+
+def parse_resolution_schedule(args):
+    """
+    [(start_epoch, img_size)] of --resolution_schedule, sorted by epoch, or None.
+    """
+    if not args.resolution_schedule:
+        return None
+    schedule = sorted(tuple(int(v) for v in entry.split(':')) for entry in args.resolution_schedule)
+    if schedule[-1][1] != args.input_size:
+        raise ValueError('the resolution schedule ends at %d, not --input_size %d' % (schedule[-1][1], args.input_size))
+    return schedule
+
+
+def resolution_at(schedule, epoch, args):
+    """
+    Image size and batch size per process of an epoch: the last schedule entry started by then
+    (--input_size before the first one). With --resolution_scale_batch the batch grows as the
+    resolution shrinks, keeping the tokens per batch constant.
+    """
+    img_size = args.input_size
+    for start_epoch, size in schedule:
+        if start_epoch <= epoch:
+            img_size = size
+    batch_size = args.batch_size
+    if args.resolution_scale_batch:
+        batch_size = int(args.batch_size * (args.input_size / img_size) ** 2)
+    return img_size, batch_size
+
+
+def build_train_loader(dataset_train, sampler_train, batch_size, args):
+    return torch.utils.data.DataLoader(
+        dataset_train, sampler=sampler_train,
+        batch_size=batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=True,
+        persistent_workers=args.num_workers > 0
+    )
+
+
+def build_students_args(args):
+    """
+    (name, args) of each student: the --students entries applied over the command line
+    args, with output and log dirs in a subdirectory per student; or the command line
+    student alone, unnamed.
+    """
+    if args.students is None:
+        return [('', args)]
+    with open(args.students, encoding='utf-8') as f:
+        configs = json.load(f)
+    students_args = []
+    for config in configs:
+        config = dict(config)
+        name = config.pop('name')
+        unknown = sorted(set(config) - set(STUDENT_ARGS))
+        if unknown:
+            raise ValueError('--students entry %s sets %s, which are not per-student args' % (name, unknown))
+        student_args = argparse.Namespace(**{**vars(args), **config})
+        if args.output_dir:
+            student_args.output_dir = os.path.join(args.output_dir, name)
+            Path(student_args.output_dir).mkdir(parents=True, exist_ok=True)
+        if args.log_dir is not None:
+            student_args.log_dir = os.path.join(args.log_dir, name)
+        students_args.append((name, student_args))
+    names = [name for name, _ in students_args]
+    assert len(set(names)) == len(names), 'student names must be unique: %s' % names
+    return students_args
+
+
+def build_student(name, args, device, teacher_latent_indices, probe_batch):
+    """
+    Model, optimizer, loss scaler, log writer and checkpoint writer of one student, with its
+    checkpoint resumed and weights frozen as its args say. Frozen parameters, and the ones
+    the loss does not use on probe_batch (images and their teacher outputs), are left out of
+    DDP and the optimizer.
+    """
+    model = models_mae_distill.__dict__[args.model](
+        norm_pix_loss=args.norm_pix_loss,
+        img_size=args.input_size,
+        embedding_distillation_func=args.embedding_distillation_func,
+        aligned_blks_indices=args.aligned_blks_indices,
+        distillation_disentangled_target=args.distillation_disentangled_target,
+        student_reconstruction_target=args.student_reconstruction_target,
+        aligned_feature_projection_mode=args.aligned_feature_projection_mode,
+        aligned_feature_projection_dim=args.aligned_feature_projection_dim
+    )
+    model.to(device)
+
+    model_without_ddp = model
+    print("Student Model %s= %s" % (name + ' ' if name else '', str(model_without_ddp)))
+
+    # before DDP and the optimizer are built, so that neither holds frozen parameters
+    misc.freeze_weights(args=args, model_without_ddp=model_without_ddp)
+
+    def probe_loss(model):
+        imgs, (latents_teacher, mask, ids_restore, ids_keep, teacher_prediction) = probe_batch
+        with misc.autocast(device, args.precision):
+            loss, loss_distillation_embedding, _, _ = model(
+                imgs, ids_keep, ids_restore, mask, teacher_prediction, args.target_sum_weights,
+                select_teacher_latents(latents_teacher, teacher_latent_indices))
+        return loss + sum(loss_distillation_embedding.values())
+    misc.freeze_unused_parameters(model_without_ddp, probe_loss)
+
+    # Count the number of parameters in the model
+    model_num_params = sum(p.numel() for p in model.parameters())
+    print(f"Number of parameters in the model: {model_num_params}")
+
+    # every masked view counts as a sample
+    eff_batch_size = args.batch_size * args.masks_per_image * args.accum_iter * misc.get_world_size()
+    if args.lr is None:  # only base_lr is specified
+        args.lr = args.blr * eff_batch_size / 256
+
+    print("base lr: %.2e" % (args.lr * 256 / eff_batch_size))
+    print("actual lr: %.2e" % args.lr)
+    print("accumulate grad iterations: %d" % args.accum_iter)
+    print("effective batch size: %d" % eff_batch_size)
+
+    if args.distributed:
+        # CPU (gloo) DDP takes no device_ids
+        device_ids = [args.gpu] if device.type == 'cuda' else None
+        if args.ddp_find_unused_parameters:
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids,
+                                                              find_unused_parameters=True)
+        else:
+            # every step backpropagates through the same parameters: no per-step graph traversal,
+            # and the gradients live in the all-reduce buckets instead of being copied there
+            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids, static_graph=True,
+                                                              gradient_as_bucket_view=True)
+        model_without_ddp = model.module
+
+    # following timm: set wd as 0 for bias and norm layers
+    param_groups = optim_factory.add_weight_decay(model_without_ddp, args.weight_decay)
+    optimizer = misc.create_adamw(param_groups, args, betas=(0.9, 0.95))
+    print(optimizer)
+    loss_scaler = NativeScaler(enabled=args.precision == 'fp16' and device.type == 'cuda')
+
+    misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
+
+    log_writer = None
+    if misc.get_rank() == 0 and args.log_dir is not None:
+        os.makedirs(args.log_dir, exist_ok=True)
+        log_writer = SummaryWriter(log_dir=args.log_dir)
+
+    checkpoint_writer = None
+    if args.async_save and args.output_dir and misc.is_main_process():
+        checkpoint_writer = misc.AsyncCheckpointWriter(args.keep_last_k)
+
+    student = DistillStudent(model, optimizer, loss_scaler, args, name=name, log_writer=log_writer,
+                             teacher_latent_indices=teacher_latent_indices)
+    return student, checkpoint_writer
+
+
 def main(args):
+    if args.keep_last_k > 0 and not args.async_save:
+        raise ValueError('--keep_last_k is applied by the asynchronous checkpoint writer, '
+                         'it cannot be combined with --no_async_save')
     misc.init_distributed_mode(args)
 
     print('job dir: {}'.format(os.path.dirname(os.path.realpath(__file__))))
@@ -187,58 +447,35 @@ def main(args):
     if True:  # args.distributed:
         num_tasks = misc.get_world_size()
         global_rank = misc.get_rank()
-        sampler_train = torch.utils.data.DistributedSampler(
+        sampler_train = ResumableDistributedSampler(
             dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
         )
         print("Sampler_train = %s" % str(sampler_train))
     else:
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
 
-    if global_rank == 0 and args.log_dir is not None:
-        os.makedirs(args.log_dir, exist_ok=True)
-        log_writer = SummaryWriter(log_dir=args.log_dir)
-    else:
-        log_writer = None
-
-    data_loader_train = torch.utils.data.DataLoader(
-        dataset_train, sampler=sampler_train,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_mem,
-        drop_last=True,
-        persistent_workers=True
-    )
-
-    # Define student model
-    model = models_mae_distill.__dict__[args.model](
-        norm_pix_loss=args.norm_pix_loss,
-        img_size=args.input_size,
-        embedding_distillation_func=args.embedding_distillation_func,
-        aligned_blks_indices=args.aligned_blks_indices,
-        distillation_disentangled_target=args.distillation_disentangled_target,
-        student_reconstruction_target=args.student_reconstruction_target,
-        aligned_feature_projection_mode=args.aligned_feature_projection_mode,
-        aligned_feature_projection_dim=args.aligned_feature_projection_dim
-    )
-    model.to(device)
-
-    model_without_ddp = model
-    print("Student Model = %s" % str(model_without_ddp))
+    resolution_schedule = parse_resolution_schedule(args)
+    data_loader_train = build_train_loader(dataset_train, sampler_train, args.batch_size, args)
 
-    # Count the number of parameters in the model
-    model_num_params = sum(p.numel() for p in model.parameters())
-    print(f"Number of parameters in the model: {model_num_params}")
+    students_args = build_students_args(args)
+    # the teacher returns the latents of every block some student is aligned to
+    teacher_blks = [student_args.aligned_blks_indices if student_args.teacher_aligned_blks_indices is None
+                    else student_args.teacher_aligned_blks_indices for _, student_args in students_args]
+    teacher_aligned_blks_indices = None
+    if any(blks is not None for blks in teacher_blks):
+        teacher_aligned_blks_indices = sorted(set(i for blks in teacher_blks if blks is not None for i in blks))
 
     # Define teacher model
     model_teacher = models_mae_distill.__dict__[args.model_teacher](
         norm_pix_loss=args.norm_pix_loss,
         img_size=args.input_size,
         embedding_distillation_func=args.embedding_distillation_func,
-        aligned_blks_indices=args.aligned_blks_indices if args.teacher_aligned_blks_indices is None
-        else args.teacher_aligned_blks_indices
+        aligned_blks_indices=teacher_aligned_blks_indices
     )
     model_teacher.to(device)
 
+    # the teacher is frozen: no gradients, and nothing for DDP to synchronize
+    model_teacher.requires_grad_(False)
     model_teacher_without_ddp = model_teacher
     print("Teacher Model = %s" % str(model_teacher_without_ddp))
 
@@ -246,57 +483,89 @@ def main(args):
     model_teacher_num_params = sum(p.numel() for p in model_teacher.parameters())
     print(f"Number of parameters in the teacher model: {model_teacher_num_params}")
 
-    eff_batch_size = args.batch_size * args.accum_iter * misc.get_world_size()
-    if args.lr is None:  # only base_lr is specified
-        args.lr = args.blr * eff_batch_size / 256
-
-    print("base lr: %.2e" % (args.lr * 256 / eff_batch_size))
-    print("actual lr: %.2e" % args.lr)
-    print("accumulate grad iterations: %d" % args.accum_iter)
-    print("effective batch size: %d" % eff_batch_size)
-
-    if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=True)
-        model_without_ddp = model.module
-        model_teacher = torch.nn.parallel.DistributedDataParallel(model_teacher, device_ids=[args.gpu],
-                                                                  find_unused_parameters=True)
-        model_teacher_without_ddp = model_teacher.module
-
-    # following timm: set wd as 0 for bias and norm layers
-    param_groups = optim_factory.add_weight_decay(model_without_ddp, args.weight_decay)
-    optimizer = torch.optim.AdamW(param_groups, lr=args.lr, betas=(0.9, 0.95))
-    print(optimizer)
-    loss_scaler = NativeScaler()
-
-    misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
     misc.load_model_teacher(args=args, model_teacher_without_ddp=model_teacher_without_ddp)
-    misc.freeze_weights(args=args, model_without_ddp=model_without_ddp)
+
+    # a teacher forward on random images, to find the student parameters the loss does not use;
+    # on a forked RNG so that the training randomness does not depend on it
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        probe_imgs = torch.randn(2, 3, args.input_size, args.input_size, device=device)
+        probe_batch = (probe_imgs, teacher_forward(model_teacher_without_ddp, probe_imgs, device, args))
+
+    students = []
+    checkpoint_writers = []
+    for (name, student_args), blks in zip(students_args, teacher_blks):
+        teacher_latent_indices = None
+        if blks is not None:
+            teacher_latent_indices = [teacher_aligned_blks_indices.index(i) for i in blks]
+        student, checkpoint_writer = build_student(name, student_args, device, teacher_latent_indices, probe_batch)
+        students.append(student)
+        checkpoint_writers.append(checkpoint_writer)
+
+    # all students go through the same batches: they must resume from the same point
+    if len(students) > 1:
+        assert len({(s.args.start_epoch, s.args.start_step) for s in students}) == 1, \
+            'students resume from different epochs: %s' % [(s.name, s.args.start_epoch) for s in students]
+        args.start_epoch, args.start_step = students[0].args.start_epoch, students[0].args.start_step
+
+    step_checkpointer = None
+    if args.ckpt_interval_minutes > 0 and args.output_dir:
+        assert len(students) == 1, '--ckpt_interval_minutes supports a single student only'
+        step_checkpointer = misc.StepCheckpointer(args, students[0].model_without_ddp, students[0].optimizer,
+                                                  students[0].loss_scaler, checkpoint_writer=checkpoint_writers[0])
+
+    if args.teacher_process and args.teacher_device is None:
+        args.teacher_device = args.device
+    if args.teacher_int8 is not None:
+        quantize_teacher(model_teacher_without_ddp, data_loader_train, students, args)
+
+    teacher_process = None
+    if args.teacher_process:
+        teacher_process = TeacherProcess(model_teacher_without_ddp, args)
 
     print(f"Start training for {args.epochs} epochs")
     start_time = time.time()
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            data_loader_train.sampler.set_epoch(epoch)
-        
-        train_stats = train_one_epoch(
-            model, model_teacher, data_loader_train,
-            optimizer, device, epoch, loss_scaler,
-            log_writer=log_writer,
-            args=args
+        if resolution_schedule is not None:
+            img_size, batch_size = resolution_at(resolution_schedule, epoch, args)
+            for model in [model_teacher_without_ddp] + [student.model_without_ddp for student in students]:
+                model.set_img_size(img_size)
+            if batch_size != data_loader_train.batch_size:
+                print("Epoch %d: resolution %d, batch size %d per process" % (epoch, img_size, batch_size))
+                data_loader_train = build_train_loader(dataset_train, sampler_train, batch_size, args)
+
+        # the train sampler is always a distributed one (a single replica without distributed mode)
+        data_loader_train.sampler.set_epoch(epoch)
+        if epoch == args.start_epoch and args.start_step > 0:
+            data_loader_train.sampler.set_start_index(args.start_step * data_loader_train.batch_size)
+
+        students_stats = train_students_one_epoch(
+            students, model_teacher, data_loader_train, device, epoch,
+            args=args,
+            step_checkpointer=step_checkpointer,
+            teacher_process=teacher_process
         )
-        
-        if args.output_dir and (epoch % 5 == 0 or epoch + 1 == args.epochs):
-            misc.save_model(
-                args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
-                loss_scaler=loss_scaler, epoch=epoch)
-
-        log_stats = {**{f'train_{k}': v for k, v in train_stats.items()}, 'epoch': epoch, }
-
-        if args.output_dir and misc.is_main_process():
-            if log_writer is not None:
-                log_writer.flush()
-            with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
-                f.write(json.dumps(log_stats) + "\n")
+
+        for student, train_stats, checkpoint_writer in zip(students, students_stats, checkpoint_writers):
+            student_args = student.args
+            if student_args.output_dir and (epoch % 5 == 0 or epoch + 1 == args.epochs):
+                misc.save_model(
+                    args=student_args, model=student.model, model_without_ddp=student.model_without_ddp,
+                    optimizer=student.optimizer, loss_scaler=student.loss_scaler, epoch=epoch,
+                    checkpoint_writer=checkpoint_writer)
+
+            log_stats = {**{f'train_{k}': v for k, v in train_stats.items()}, 'epoch': epoch, }
+
+            if student_args.output_dir and misc.is_main_process():
+                if student.log_writer is not None:
+                    student.log_writer.flush()
+                with open(os.path.join(student_args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+                    f.write(json.dumps(log_stats) + "\n")
+
+    for checkpoint_writer in checkpoint_writers:
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
+    if teacher_process is not None:
+        teacher_process.close()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -0,0 +1,220 @@
+# --------------------------------------------------------
+# Evaluate many fine-tuned checkpoints in a single pass over the test set:
+# every batch is decoded once and fed to all models.
+# --------------------------------------------------------
+
+import argparse
+import copy
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state
+import torchvision.transforms as transforms
+
+import util.misc as misc
+from util.metrics import multilabel_auroc, StreamingAUROC
+from util.sampler import DistributedEvalSampler
+from util.dataloader_medical import CheXpert, ChestX_ray14
+
+from models import models_vit
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Multi-checkpoint evaluation for medical image classification', add_help=False)
+    parser.add_argument('--checkpoints', nargs='+', type=str, required=True,
+                        help='checkpoint files or glob patterns, e.g. "work_dirs/run/checkpoint-*.pth"')
+    parser.add_argument('--batch_size', default=64, type=int,
+                        help='Batch size per GPU')
+
+    # Model parameters
+    parser.add_argument('--model', default='vit_large_patch16', type=str, metavar='MODEL',
+                        help='Name of the evaluated model (shared by all checkpoints)')
+    parser.add_argument('--input_size', default=224, type=int,
+                        help='images input size')
+    parser.add_argument('--global_pool', action='store_true')
+    parser.set_defaults(global_pool=True)
+    parser.add_argument('--stack_models', action='store_true', default=False,
+                        help='run all checkpoints as one batched model with torch.func.vmap')
+
+    # Dataset parameters
+    parser.add_argument("--dataset", default='chestxray14', type=str)
+    parser.add_argument('--split', default='test', type=str, choices=['val', 'test'])
+    parser.add_argument('--nb_classes', default=14, type=int,
+                        help='number of the classification types')
+    parser.add_argument('--auroc_bins', default=0, type=int,
+                        help='compute AUROC from per-class score histograms with this many bins, 0 for exact AUROC')
+    parser.add_argument('--output_json', default=None, type=str,
+                        help='where to write the AUROC table')
+    parser.add_argument('--device', default='cuda',
+                        help='device to use for testing')
+    parser.add_argument('--precision', default='fp16', type=str, choices=['fp32', 'fp16', 'bf16'])
+    parser.add_argument('--num_workers', default=10, type=int)
+    parser.add_argument('--pin_mem', action='store_true')
+    parser.add_argument('--no_pin_mem', action='store_false', dest='pin_mem')
+    parser.set_defaults(pin_mem=True)
+
+    # distributed parameters
+    parser.add_argument('--world_size', default=1, type=int,
+                        help='number of distributed processes')
+    parser.add_argument('--local_rank', default=-1, type=int)
+    parser.add_argument('--dist_on_itp', action='store_true')
+    parser.add_argument('--dist_url', default='env://',
+                        help='url used to set up distributed training')
+    parser.add_argument('--cpu_threads', default=0, type=int)
+
+    return parser
+
+
+def build_eval_dataset(args):
+    mean_dict = { 'chexpert': [0.485, 0.456, 0.406], 'chestxray14': [0.5056, 0.5056, 0.5056] }
+    std_dict = { 'chexpert': [0.229, 0.224, 0.225], 'chestxray14': [0.252, 0.252, 0.252] }
+
+    transform_eval = transforms.Compose([
+        transforms.Resize((args.input_size, args.input_size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean_dict[args.dataset], std_dict[args.dataset])]
+    )
+
+    if args.dataset == 'chexpert':
+        # CheXpert doesn't have a test set, so we use the validation set for testing
+        dataset = CheXpert(csv_path="data/chexpert/valid.csv", image_root_path='data/chexpert/', use_upsampling=False,
+                           use_frontal=True, mode='valid', class_index=-1, transform=transform_eval,
+                           heatmap_path=None, pretraining=False)
+    elif args.dataset == 'chestxray14':
+        dataset = ChestX_ray14('data/chestxray14/images', 'data/chestxray14/%s_official.txt' % args.split,
+                               augment=transform_eval, num_class=14, heatmap_path=None, pretraining=False)
+    else:
+        raise NotImplementedError
+    return dataset
+
+
+def load_models(args, checkpoint_paths, device):
+    models = []
+    for checkpoint_path in checkpoint_paths:
+        model = models_vit.__dict__[args.model](
+            img_size=args.input_size,
+            num_classes=args.nb_classes,
+            global_pool=args.global_pool,
+        )
+        model.load_state_dict(misc.load_state_dict_file(checkpoint_path))
+        model.to(device)
+        model.eval()
+        models.append(model)
+        print("Loaded checkpoint %s" % checkpoint_path)
+    return models
+
+
+def stacked_forward(models):
+    """
+    One vmapped forward over the stacked weights of identical models: [B, ...] -> [M, B, C].
+    """
+    params, buffers = stack_module_state(models)
+    base_model = copy.deepcopy(models[0]).to('meta')
+
+    def forward(params, buffers, images):
+        return functional_call(base_model, (params, buffers), (images,))
+
+    return lambda images: torch.vmap(forward, in_dims=(0, 0, None))(params, buffers, images)
+
+
+@torch.no_grad()
+def evaluate_checkpoints(data_loader, models, device, args):
+    num_models = len(models)
+    sharded = isinstance(data_loader.sampler, DistributedEvalSampler)
+    forward = stacked_forward(models) if args.stack_models else None
+
+    if args.auroc_bins > 0:
+        streaming_aurocs = [StreamingAUROC(args.nb_classes, args.auroc_bins, device=device) for _ in models]
+    else:
+        outputs = [[] for _ in models]
+        targets = []
+
+    metric_logger = misc.MetricLogger(delimiter="  ")
+    header = 'Test ({} checkpoints):'.format(num_models)
+    for batch in metric_logger.log_every(data_loader, 10, header):
+        images = batch[0].to(device, non_blocking=True)
+        target = batch[-1].to(device, non_blocking=True)
+
+        with misc.autocast(device, args.precision):
+            if forward is not None:
+                batch_outputs = forward(images)
+            else:
+                batch_outputs = [model(images) for model in models]
+
+        for i in range(num_models):
+            if args.auroc_bins > 0:
+                streaming_aurocs[i].update(target, batch_outputs[i].float().sigmoid())
+            else:
+                outputs[i].append(batch_outputs[i].float())
+        if args.auroc_bins <= 0:
+            targets.append(target.float())
+
+    if args.auroc_bins > 0:
+        aucs = []
+        for streaming_auroc in streaming_aurocs:
+            if sharded:
+                streaming_auroc.synchronize_between_processes()
+            aucs.append(streaming_auroc.compute())
+        return torch.stack(aucs)
+
+    # [N, M * C + C]: all predictions and the targets, gathered in one collective when sharded
+    results = torch.cat([torch.cat(o, dim=0) for o in outputs] + [torch.cat(targets, dim=0)], dim=1)
+    if sharded:
+        results = misc.all_gather_sharded(results, len(data_loader.dataset))
+    results = results.view(results.shape[0], num_models + 1, -1)
+    targets = results[:, -1]
+    return torch.stack([multilabel_auroc(targets, results[:, i].sigmoid()) for i in range(num_models)])
+
+
+def main(args):
+    misc.init_distributed_mode(args)
+    print("{}".format(args).replace(', ', ',\n'))
+    device = torch.device(args.device)
+
+    checkpoint_paths = []
+    for pattern in args.checkpoints:
+        matches = sorted(glob.glob(pattern))
+        checkpoint_paths += matches if matches else [pattern]
+    print("Evaluating %d checkpoints" % len(checkpoint_paths))
+
+    dataset = build_eval_dataset(args)
+    if args.distributed:
+        sampler = DistributedEvalSampler(dataset, num_replicas=misc.get_world_size(), rank=misc.get_rank())
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    data_loader = torch.utils.data.DataLoader(
+        dataset, sampler=sampler,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=False
+    )
+
+    models = load_models(args, checkpoint_paths, device)
+    aucs = evaluate_checkpoints(data_loader, models, device, args).cpu().numpy()
+
+    table = []
+    print('\t'.join(['checkpoint', 'auc_avg'] + ['class_%d' % i for i in range(args.nb_classes)]))
+    for checkpoint_path, auc_each_class in zip(checkpoint_paths, aucs):
+        # classes without both labels are left out of the average, as in evaluate_medical
+        auc_avg = float(np.nanmean(auc_each_class))
+        table.append({'checkpoint': checkpoint_path, 'auc_avg': auc_avg,
+                      'auc_each_class': np.nan_to_num(auc_each_class).tolist()})
+        print('\t'.join([os.path.basename(checkpoint_path), '%.4f' % auc_avg] +
+                        ['%.4f' % a for a in auc_each_class]))
+
+    best = max(table, key=lambda row: row['auc_avg'])
+    print('Best checkpoint: %s (Average AUC %.4f)' % (best['checkpoint'], best['auc_avg']))
+
+    if args.output_json and misc.is_main_process():
+        with open(args.output_json, mode='w', encoding='utf-8') as f:
+            json.dump(table, f, indent=2)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
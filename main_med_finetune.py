@@ -32,14 +32,14 @@ from util.misc import NativeScalerWithGradNormCount as NativeScaler
 
 from models import models_vit
 
-from engine_med_finetune import train_one_epoch, evaluate_medical
-from util.sampler import RASampler
+from engine_med_finetune import train_one_epoch, evaluate_medical, AsyncEvaluator
+from util.sampler import RASampler, DistributedEvalSampler, ResumableDistributedSampler
 from libauc import losses
 from torchvision import models
 import timm.optim.optim_factory as optim_factory
 from collections import OrderedDict
 
-from util.dataloader_medical import CheXpert, ChestX_ray14
+from util.dataloader_medical import CheXpert, ChestX_ray14, CachedEvalDataset
 import torchvision.transforms as transforms
 
 def get_args_parser():
@@ -79,6 +79,11 @@ def get_args_parser():
     parser.add_argument('--min_lr', type=float, default=1e-6, metavar='LR',
                     help='lower lr bound for cyclic schedulers that hit 0')
     parser.add_argument("--optimizer", default='adamw', type=str)
+    parser.add_argument('--opt_impl', default='fused', type=str, choices=['default', 'foreach', 'fused'],
+                        help='AdamW implementation (fused falls back to foreach where unsupported)')
+    parser.add_argument('--shard_optimizer', action='store_true', default=False,
+                        help='shard the AdamW states across the distributed processes (ZeRO stage 1); '
+                             'checkpoints hold the consolidated states and load with or without it')
     parser.add_argument('--loss_func', default=None, type=str)
 
     parser.add_argument('--warmup_epochs', type=int, default=5, metavar='N',
@@ -121,17 +126,53 @@ def get_args_parser():
     parser.add_argument('--device', default='cuda',
                         help='device to use for training / testing')
     parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--precision', default='fp16', type=str, choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast precision; fp16 uses loss scaling on CUDA, bf16 also works on CPU')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='time the phases of every training step and report images/s, tokens/s and MFU')
+    parser.add_argument('--profile_trace_steps', default=0, type=int,
+                        help='write a torch.profiler trace of this many steps of the first epoch to log_dir/trace')
+    parser.add_argument('--profile_trace_wait', default=10, type=int,
+                        help='steps to skip before the traced ones')
+    parser.add_argument('--peak_tflops', default=0, type=float,
+                        help='peak TFLOPS of one device for MFU (0: known GPUs only)')
     parser.add_argument('--resume', default='',
                         help='resume from checkpoint')
     parser.add_argument("--checkpoint_type", default=None, type=str)
 
     parser.add_argument('--start_epoch', default=0, type=int, metavar='N',
                         help='start epoch')
+    parser.add_argument('--start_step', default=0, type=int, metavar='N',
+                        help='iteration to start the start epoch at (set when resuming a mid-epoch checkpoint)')
+    parser.add_argument('--ckpt_interval_minutes', default=0, type=float,
+                        help='also write output_dir/checkpoint-last.pth about every this many minutes '
+                             'within an epoch, resumable with --resume (0: off)')
     parser.add_argument('--eval', action='store_true',
                         help='Perform evaluation only')
     parser.add_argument('--eval_interval', default=10, type=int)
     parser.add_argument('--dist_eval', action='store_true', default=False,
-                        help='Enabling distributed evaluation (recommended during training for faster monitor')
+                        help='Shard evaluation over processes and gather the predictions for an exact global AUROC')
+    parser.add_argument('--async_eval', action='store_true', default=False,
+                        help='Evaluate the saved checkpoints in a separate process while training continues')
+    parser.add_argument('--async_eval_device', default='cpu',
+                        help='device of the asynchronous evaluator, e.g. cpu or a spare cuda:N')
+    parser.add_argument('--async_eval_threads', default=0, type=int,
+                        help='CPU threads of the asynchronous evaluator (0: torch default)')
+    parser.add_argument('--async_save', action='store_true',
+                        help='Write checkpoints from a background thread')
+    parser.add_argument('--no_async_save', action='store_false', dest='async_save')
+    parser.set_defaults(async_save=True)
+    parser.add_argument('--keep_last_k', default=0, type=int,
+                        help='keep only the last K checkpoints on disk (0: keep all); needs --async_save')
+    parser.add_argument('--keep_best_k', default=0, type=int,
+                        help='with --keep_last_k, also keep the K checkpoints with the best Average AUC')
+    parser.add_argument('--cache_eval', action='store_true',
+                        help='Decode the evaluation set once and keep it in memory (uint8) for all evaluations')
+    parser.add_argument('--no_cache_eval', action='store_false', dest='cache_eval')
+    parser.set_defaults(cache_eval=True)
+    parser.add_argument('--auroc_bins', default=0, type=int,
+                        help='compute AUROC from per-class score histograms with this many bins (bounded memory), '
+                             '0 keeps all predictions for the exact AUROC')
     parser.add_argument('--num_workers', default=10, type=int)
     parser.add_argument('--pin_mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
@@ -145,11 +186,40 @@ def get_args_parser():
     parser.add_argument('--dist_on_itp', action='store_true')
     parser.add_argument('--dist_url', default='env://',
                         help='url used to set up distributed training')
+    parser.add_argument('--cpu_threads', default=0, type=int,
+                        help='intra-op threads per process with --device cpu (0: split the cores evenly between local processes)')
 
     return parser
 
 
+def log_eval_stats(args, log_writer, epoch, train_stats, test_stats, n_parameters, max_auc):
+    if test_stats is None:
+        return max_auc
+    print(f"Average AUC on the test set images: {test_stats['auc_avg']:.4f}")
+    max_auc = max(max_auc, test_stats['auc_avg'])
+    print(f'Max Average AUC: {max_auc:.4f}', {max_auc})
+
+    if log_writer is not None:
+        log_writer.add_scalar('perf/auc_avg', test_stats['auc_avg'], epoch)
+        log_writer.add_scalar('perf/test_loss', test_stats['loss'], epoch)
+
+    log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                    **{f'test_{k}': v for k, v in test_stats.items()},
+                    'epoch': epoch,
+                    'n_parameters': n_parameters}
+
+    if args.output_dir and misc.is_main_process():
+        if log_writer is not None:
+            log_writer.flush()
+        with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
+            f.write(json.dumps(log_stats) + "\n")
+    return max_auc
+
+
 def main(args):
+    if args.keep_last_k > 0 and not args.async_save:
+        raise ValueError('--keep_last_k is applied by the asynchronous checkpoint writer, '
+                         'it cannot be combined with --no_async_save')
     misc.init_distributed_mode(args)
 
     print('job dir: {}'.format(os.path.dirname(os.path.realpath(__file__))))
@@ -199,6 +269,20 @@ def main(args):
             transforms.Normalize(dataset_mean, dataset_std)]
         )
 
+    # evaluation is deterministic: no flip. With --cache_eval the transform stops at uint8
+    # and CachedEvalDataset keeps the decoded images in memory and normalizes them on access
+    if args.cache_eval:
+        transform_eval = transforms.Compose([
+            transforms.Resize((args.input_size, args.input_size)),
+            transforms.PILToTensor()]
+        )
+    else:
+        transform_eval = transforms.Compose([
+            transforms.Resize((args.input_size, args.input_size)),
+            transforms.ToTensor(),
+            transforms.Normalize(dataset_mean, dataset_std)]
+        )
+
     heatmap_path = None
     if mask_strategy in ['heatmap_weighted', 'heatmap_inverse_weighted']:
         heatmap_path = 'nih_bbox_heatmap.png'
@@ -208,18 +292,16 @@ def main(args):
                             use_frontal=True, mode='train', class_index=-1, transform=transform_train,
                             heatmap_path=heatmap_path, pretraining=False)
         dataset_val = CheXpert(csv_path="data/chexpert/valid.csv", image_root_path='data/chexpert/', use_upsampling=False,
-                            use_frontal=True, mode='valid', class_index=-1, transform=transform_train,
+                            use_frontal=True, mode='valid', class_index=-1, transform=transform_eval,
                             heatmap_path=heatmap_path, pretraining=False)
         # CheXpert doesn't have a test set, so we use the validation set for testing
-        dataset_test = CheXpert(csv_path="data/chexpert/valid.csv", image_root_path='data/chexpert/', use_upsampling=False,
-                            use_frontal=True, mode='valid', class_index=-1, transform=transform_train,
-                            heatmap_path=heatmap_path, pretraining=False)
+        dataset_test = dataset_val
     elif args.dataset == 'chestxray14':
         dataset_train = ChestX_ray14('data/chestxray14/images', 'data/chestxray14/train_official.txt', augment=transform_train, num_class=14,
                                 heatmap_path=heatmap_path, pretraining=False)
-        dataset_val = ChestX_ray14('data/chestxray14/images', 'data/chestxray14/val_official.txt', augment=transform_train, num_class=14,
+        dataset_val = ChestX_ray14('data/chestxray14/images', 'data/chestxray14/val_official.txt', augment=transform_eval, num_class=14,
                                 heatmap_path=heatmap_path, pretraining=False)
-        dataset_test = ChestX_ray14('data/chestxray14/images', 'data/chestxray14/test_official.txt', augment=transform_train, num_class=14,
+        dataset_test = ChestX_ray14('data/chestxray14/images', 'data/chestxray14/test_official.txt', augment=transform_eval, num_class=14,
                                 heatmap_path=heatmap_path, pretraining=False)
     else:
         raise NotImplementedError
@@ -230,15 +312,12 @@ def main(args):
         if args.repeated_aug:
             sampler_train = RASampler(dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True)
         else:
-            sampler_train = torch.utils.data.DistributedSampler(dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True)
+            sampler_train = ResumableDistributedSampler(dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True)
         print("Sampler_train = %s" % str(sampler_train))
         if args.dist_eval:
-            if len(dataset_test) % num_tasks != 0:
-                print('Warning: Enabling distributed evaluation with an eval dataset not divisible by process number. '
-                      'This will slightly alter validation results as extra duplicate entries are added to achieve '
-                      'equal num of samples per-process.')
-            sampler_val = torch.utils.data.DistributedSampler(dataset_val, num_replicas=num_tasks, rank=global_rank, shuffle=True) # shuffle=True to reduce monitor bias
-            sampler_test = torch.utils.data.DistributedSampler(dataset_test, num_replicas=num_tasks, rank=global_rank, shuffle=True)
+            # every process evaluates its own shard, predictions are gathered for a global AUROC
+            sampler_val = DistributedEvalSampler(dataset_val, num_replicas=num_tasks, rank=global_rank)
+            sampler_test = DistributedEvalSampler(dataset_test, num_replicas=num_tasks, rank=global_rank)
         else:
             sampler_val = torch.utils.data.SequentialSampler(dataset_val)
             sampler_test = torch.utils.data.SequentialSampler(dataset_test)
@@ -247,6 +326,17 @@ def main(args):
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
         sampler_test = torch.utils.data.SequentialSampler(dataset_test)
 
+    if args.cache_eval:
+        # training only evaluates on the val set and --eval only on the test set, so only that one
+        # is cached, and only the samples this process evaluates
+        if args.eval:
+            dataset_test = CachedEvalDataset(dataset_test, dataset_mean, dataset_std, indices=list(sampler_test))
+        elif not args.async_eval:
+            dataset_val = CachedEvalDataset(dataset_val, dataset_mean, dataset_std, indices=list(sampler_val))
+        elif misc.is_main_process():
+            # the asynchronous evaluator of rank 0 runs the whole val set in one process
+            dataset_val = CachedEvalDataset(dataset_val, dataset_mean, dataset_std)
+
     if global_rank == 0 and args.log_dir is not None and not args.eval:
         os.makedirs(args.log_dir, exist_ok=True)
         log_writer = SummaryWriter(log_dir=args.log_dir)
@@ -301,20 +391,21 @@ def main(args):
 
     if args.finetune and not args.eval:
         if 'vit' in args.model:
-            checkpoint = torch.load(args.finetune, map_location='cpu')
+            checkpoint_model = misc.load_state_dict_file(args.finetune)
 
             print("Load pre-trained checkpoint from: %s" % args.finetune)
-            checkpoint_model = checkpoint['model']
-            state_dict = model.state_dict()
-            for k in checkpoint_model.keys():
-                if k in state_dict:
-                    if checkpoint_model[k].shape == state_dict[k].shape:
-                        state_dict[k] = checkpoint_model[k]
-                        print(f"Loaded Index: {k} from Saved Weights")
+            # exported encoders (export_encoder.py) are already in this model's layout
+            if not args.finetune.endswith('.safetensors'):
+                state_dict = model.state_dict()
+                for k in checkpoint_model.keys():
+                    if k in state_dict:
+                        if checkpoint_model[k].shape == state_dict[k].shape:
+                            state_dict[k] = checkpoint_model[k]
+                            print(f"Loaded Index: {k} from Saved Weights")
+                        else:
+                            print(f"Shape of {k} doesn't match with {state_dict[k]}")
                     else:
-                        print(f"Shape of {k} doesn't match with {state_dict[k]}")
-                else:
-                    print(f"{k} not found in Init Model")
+                        print(f"{k} not found in Init Model")
 
             # interpolate position embedding
             interpolate_pos_embed(model, checkpoint_model)
@@ -369,7 +460,9 @@ def main(args):
     print("effective batch size: %d" % eff_batch_size)
 
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        # CPU (gloo) DDP takes no device_ids
+        device_ids = [args.gpu] if device.type == 'cuda' else None
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=device_ids)
         model_without_ddp = model.module
 
     # build optimizer with layer-wise lr decay (lrd)
@@ -382,10 +475,10 @@ def main(args):
         param_groups = optim_factory.add_weight_decay(model_without_ddp, args.weight_decay)
 
     if args.optimizer == 'adamw':
-        optimizer = torch.optim.AdamW(param_groups, lr=args.lr)
+        optimizer = misc.create_adamw(param_groups, args)
     # elif args.optimizer == 'fusedlamb':
     #     optimizer = FusedAdam(param_groups, lr=args.lr)
-    loss_scaler = NativeScaler()
+    loss_scaler = NativeScaler(enabled=args.precision == 'fp16' and device.type == 'cuda')
 
     if args.dataset == 'chestxray14':
         if mixup_fn is not None:
@@ -409,44 +502,70 @@ def main(args):
         print(f"Average AUC of the network on the test set images: {test_stats['auc_avg']:.4f}")
         exit(0)
 
+    checkpoint_writer = None
+    if args.async_save and args.output_dir and misc.is_main_process():
+        # the asynchronous evaluator loads every saved checkpoint: none is removed before it is scored
+        checkpoint_writer = misc.AsyncCheckpointWriter(args.keep_last_k, args.keep_best_k,
+                                                       keep_unscored=args.async_eval)
+    checkpoint_paths = {}
+    step_checkpointer = None
+    if args.ckpt_interval_minutes > 0 and args.output_dir:
+        step_checkpointer = misc.StepCheckpointer(args, model_without_ddp, optimizer, loss_scaler,
+                                                  checkpoint_writer=checkpoint_writer)
+
+    # with --async_eval rank 0 hands the saved checkpoints to an evaluator process and training goes on
+    async_evaluator = None
+    if args.async_eval and args.output_dir and misc.is_main_process():
+        async_evaluator = AsyncEvaluator(args, dataset_val)
+
+    def record_eval(epoch, train_stats, test_stats, max_auc):
+        if checkpoint_writer is not None:
+            checkpoint_writer.set_metric(checkpoint_paths[epoch],
+                                         test_stats['auc_avg'] if test_stats is not None else float('-inf'))
+        return log_eval_stats(args, log_writer, epoch, train_stats, test_stats, n_parameters, max_auc)
+
     print(f"Start training for {args.epochs} epochs")
     start_time = time.time()
     max_auc = 0.0
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            data_loader_train.sampler.set_epoch(epoch)
+        # the train sampler is always a distributed one (a single replica without distributed mode)
+        data_loader_train.sampler.set_epoch(epoch)
+        if epoch == args.start_epoch and args.start_step > 0:
+            data_loader_train.sampler.set_start_index(args.start_step * args.batch_size)
         train_stats = train_one_epoch(
             model, criterion, data_loader_train,
             optimizer, device, epoch, loss_scaler,
             args.clip_grad, mixup_fn,
             log_writer=log_writer,
-            args=args
+            args=args,
+            step_checkpointer=step_checkpointer
         )
 
         if args.output_dir and (epoch % args.eval_interval == 0 or epoch + 1 == args.epochs):
-            misc.save_model(
+            # the evaluator only gets the checkpoint once the file is completely written
+            on_saved = None
+            if async_evaluator is not None:
+                on_saved = lambda path, epoch=epoch, train_stats=train_stats: async_evaluator.submit(
+                    path, epoch, train_stats)
+            checkpoint_paths[epoch] = misc.save_model(
                 args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
-                loss_scaler=loss_scaler, epoch=epoch)
-
-            test_stats = evaluate_medical(data_loader_val, model, device, args)
-            print(f"Average AUC on the test set images: {test_stats['auc_avg']:.4f}")
-            max_auc = max(max_auc, test_stats['auc_avg'])
-            print(f'Max Average AUC: {max_auc:.4f}', {max_auc})
-
-            if log_writer is not None:
-                log_writer.add_scalar('perf/auc_avg', test_stats['auc_avg'], epoch)
-                log_writer.add_scalar('perf/test_loss', test_stats['loss'], epoch)
-
-            log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                            **{f'test_{k}': v for k, v in test_stats.items()},
-                            'epoch': epoch,
-                            'n_parameters': n_parameters}
-
-            if args.output_dir and misc.is_main_process():
-                if log_writer is not None:
-                    log_writer.flush()
-                with open(os.path.join(args.output_dir, "log.txt"), mode="a", encoding="utf-8") as f:
-                    f.write(json.dumps(log_stats) + "\n")
+                loss_scaler=loss_scaler, epoch=epoch, checkpoint_writer=checkpoint_writer, on_saved=on_saved)
+
+            if not args.async_eval:
+                test_stats = evaluate_medical(data_loader_val, model, device, args)
+                max_auc = record_eval(epoch, train_stats, test_stats, max_auc)
+
+        if async_evaluator is not None:
+            for eval_epoch, eval_train_stats, test_stats in async_evaluator.poll():
+                max_auc = record_eval(eval_epoch, eval_train_stats, test_stats, max_auc)
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+    if async_evaluator is not None:
+        for eval_epoch, eval_train_stats, test_stats in async_evaluator.close():
+            max_auc = record_eval(eval_epoch, eval_train_stats, test_stats, max_auc)
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
@@ -19,5 +19,6 @@ OMP_NUM_THREADS=1 python -m torch.distributed.launch \
     --vit_dropout_rate 0 \
     --num_workers 4 \
     --eval_interval 10 \
+    --dist_eval \
     --resume "finetuned_small_tiny_chestxray14_100epochs.pth" \
     --eval
\ No newline at end of file
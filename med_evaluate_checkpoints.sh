@@ -0,0 +1,15 @@
+EXP_NAME=finetuned_tiny_model
+SAVE_DIR="./work_dirs/${EXP_NAME}_e1/"
+GPUS=4
+
+OMP_NUM_THREADS=1 python -m torch.distributed.launch \
+    --nproc_per_node=${GPUS} \
+    --use_env main_med_evaluate.py \
+    --checkpoints "${SAVE_DIR}checkpoint-*.pth" \
+    --output_json ${SAVE_DIR}checkpoints_auc.json \
+    --batch_size 32 \
+    --model vit_tiny_patch16 \
+    --dataset chestxray14 \
+    --nb_classes 14 \
+    --num_workers 4 \
+    --stack_models
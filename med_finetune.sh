@@ -19,4 +19,5 @@ OMP_NUM_THREADS=1 python -m torch.distributed.launch \
     --mixup 0 --cutmix 0 \
     --vit_dropout_rate 0 \
     --num_workers 4 \
-    --eval_interval 10 \
\ No newline at end of file
+    --eval_interval 10 \
+    --dist_eval \
\ No newline at end of file
@@ -93,7 +93,7 @@ class MaskedAutoencoderViT(nn.Module):
                 student_feature_dim, teacher_feature_dim = aligned_feature_projection_dim
                 self.aligned_feature_projection_heads = nn.ModuleList([
                     nn.Sequential(*[
-                    Mlp(in_features=_feature_dim, hidden_features=teacher_feature_dim, out_features= teacher_feature_dim, act_layer=nn.GELU, drop=0.0),
+                    Mlp(in_features=student_feature_dim, hidden_features=teacher_feature_dim, out_features= teacher_feature_dim, act_layer=nn.GELU, drop=0.0),
                     Mlp(in_features=teacher_feature_dim, hidden_features=teacher_feature_dim, out_features= teacher_feature_dim, act_layer=nn.GELU, drop=0.0)])
                     for i in range(len(self.aligned_blks_indices))]
                 )
@@ -122,6 +122,34 @@ class MaskedAutoencoderViT(nn.Module):
         # initialize nn.Linear and nn.LayerNorm
         self.apply(self._init_weights)
 
+    def set_img_size(self, img_size):
+        """
+        Switch the model to img_size x img_size inputs: the fixed sin-cos pos_embed and
+        decoder_pos_embed are regenerated for the new patch grid (used by progressive-resolution
+        distillation). All other weights are resolution independent.
+        """
+        patch_size = self.patch_embed.patch_size[0]
+        assert img_size % patch_size == 0, 'img_size %d is not a multiple of the patch size %d' % (img_size, patch_size)
+        grid_size = img_size // patch_size
+        if self.patch_embed.num_patches == grid_size ** 2:
+            return
+        self.patch_embed.img_size = (img_size, img_size)
+        self.patch_embed.num_patches = grid_size ** 2
+        for pos_embed in (self.pos_embed, self.decoder_pos_embed):
+            # same Parameter object, new shape: optimizers and DDP hold no state for these frozen tensors
+            pos_embed.data = torch.from_numpy(
+                get_2d_sincos_pos_embed(pos_embed.shape[-1], grid_size, cls_token=True)).float().unsqueeze(0).to(
+                pos_embed.device)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints of progressive-resolution runs may hold the pos embeds of another grid: they are
+        # fixed sin-cos tables, so keep the ones of the model's grid (the caller resizes the model)
+        for name in ('pos_embed', 'decoder_pos_embed'):
+            pos_embed = state_dict.get(prefix + name)
+            if pos_embed is not None and pos_embed.shape != getattr(self, name).shape:
+                state_dict[prefix + name] = getattr(self, name).detach().clone()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             # we use xavier_uniform following official JAX ViT:
@@ -304,15 +332,22 @@ class MaskedAutoencoderViT(nn.Module):
         else:
             return outs
 
+    def unshuffle_tokens(self, x, ids_restore):
+        """
+        x: [N, 1 + len_keep, D], cls token and visible tokens in shuffled order
+        returns [N, 1 + L, D] with mask tokens inserted and the patches in their original order
+        """
+        mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
+        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
+        x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
+        return torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
+
     def forward_decoder(self, x, ids_restore):
         # embed tokens
         x = self.decoder_embed(x)
 
         # append mask tokens to sequence
-        mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
-        x_ = torch.cat([x[:, 1:, :], mask_tokens], dim=1)  # no cls token
-        x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
-        x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
+        x = self.unshuffle_tokens(x, ids_restore)
 
         # add pos embed
         x = x + self.decoder_pos_embed
@@ -0,0 +1,109 @@
+# --------------------------------------------------------
+# Plot metrics of many runs from their log.txt files
+#
+# The logs matching --logs are ingested incrementally into the columnar store at
+# --store (see util/metrics_store.py), then only the plotted columns are read.
+# Usage (from the repository root):
+#   python plot_metrics.py --logs 'work_dirs/*/log.txt' --y train_loss --output distill_loss.png
+#   python plot_metrics.py --logs 'work_dirs/finetune_*/log.txt' --y test_auc_avg --best max
+# --------------------------------------------------------
+
+import argparse
+
+import numpy as np
+
+from util.metrics_store import MetricsStore
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Plot metrics of many runs', add_help=False)
+    parser.add_argument('--logs', nargs='+', type=str, default=[],
+                        help='globs of JSON-lines logs to ingest (quote them), e.g. "work_dirs/*/log.txt"')
+    parser.add_argument('--store', default='./work_dirs/metrics_store', type=str,
+                        help='directory of the columnar metrics store')
+    parser.add_argument('--root', default=None, type=str,
+                        help='runs are named by their log path relative to this (default: working directory)')
+    parser.add_argument('--runs', nargs='+', type=str, default=['*'],
+                        help='globs over the run names in the store to plot')
+    parser.add_argument('--x', default='epoch', type=str, help='column of the x axis')
+    parser.add_argument('--y', nargs='+', type=str, default=['train_loss'],
+                        help='columns to plot; "name.*" plots every entry of a logged list')
+    parser.add_argument('--best', default=None, choices=['min', 'max'],
+                        help='also print the best value of each y column per run')
+    parser.add_argument('--list_columns', action='store_true', help='print the columns of each run and exit')
+    parser.add_argument('--title', default=None, type=str)
+    parser.add_argument('--ylabel', default=None, type=str)
+    parser.add_argument('--output', default=None, type=str, help='image file to write (no plot if unset)')
+    return parser
+
+
+def select_runs(store, patterns):
+    runs = []
+    for pattern in patterns:
+        runs += [run for run in store.runs(pattern) if run not in runs]
+    return runs
+
+
+def plot_runs(store, runs, x, ys, output, title=None, ylabel=None, labels=None, column_labels=None):
+    """
+    One line per run and y column. labels maps run names to legend names, column_labels
+    y columns to the suffix of their legend entries.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    for run in runs:
+        data = store.load(run, [x] + ys)
+        label = (labels or {}).get(run, run)
+        for column, values in data.items():
+            if column == x:
+                continue
+            valid = ~np.isnan(values)
+            suffix = '' if len(ys) == 1 and not ys[0].endswith('.*') else ' (%s)' % column
+            if column_labels is not None and column in column_labels:
+                suffix = ' (%s)' % column_labels[column]
+            plt.plot(data[x][valid], values[valid], label=label + suffix)
+    if title is not None:
+        plt.title(title)
+    plt.xlabel(x.capitalize() if x == 'epoch' else x)
+    plt.ylabel(ylabel or ', '.join(ys))
+    plt.legend()
+    plt.savefig(output)
+    plt.clf()
+
+
+def main(args):
+    store = MetricsStore(args.store)
+    if args.logs:
+        new_rows = store.ingest_glob(args.logs, root=args.root)
+        print('Ingested %d new rows from %d logs' % (sum(new_rows.values()), len(new_rows)))
+    runs = select_runs(store, args.runs)
+    if not runs:
+        print('No runs in %s match %s' % (args.store, args.runs))
+        return
+
+    if args.list_columns:
+        for run in runs:
+            print('%s (%d rows): %s' % (run, store.index[run]['rows'], ', '.join(store.columns(run))))
+        return
+
+    if args.best is not None:
+        reduce_fn, arg_fn = (np.nanmin, np.nanargmin) if args.best == 'min' else (np.nanmax, np.nanargmax)
+        for run in runs:
+            data = store.load(run, [args.x] + args.y)
+            for column, values in data.items():
+                if column == args.x or np.isnan(values).all():
+                    continue
+                print('%s\t%s\t%s %.4f at %s %g' % (run, column, args.best, reduce_fn(values), args.x,
+                                                   data[args.x][arg_fn(values)]))
+
+    if args.output:
+        plot_runs(store, runs, args.x, args.y, args.output, title=args.title, ylabel=args.ylabel)
+        print('Saved %s' % args.output)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -261,6 +261,56 @@ class CheXpert(Dataset):
 
             return [image, heatmap], label
 
+class CachedEvalDataset(Dataset):
+    '''
+    Wraps an evaluation dataset with a deterministic transform that returns uint8 image
+    tensors (e.g. Resize + PILToTensor). Every sample is decoded once, kept as uint8 in
+    shared memory (so DataLoader workers fill and read the same cache) and normalized
+    on access, so repeated evaluations never touch the disk again.
+    Only `indices` (those the sampler of this process visits) are cached. Chest X-rays
+    are grayscale, so with grayscale=True a single channel is stored.
+    '''
+
+    def __init__(self, dataset, mean, std, indices=None, grayscale=True):
+        self.dataset = dataset
+        if indices is None:
+            indices = range(len(dataset))
+        self.slots = {idx: slot for slot, idx in enumerate(indices)}
+        self.channels = 1 if grayscale else 3
+
+        # the shapes come from the first sample of this process, which is cached right away
+        first = next(iter(self.slots), 0)
+        image, label = dataset[first]
+        assert image.dtype == torch.uint8, 'CachedEvalDataset expects a transform returning uint8 tensors'
+        self.images = torch.zeros((len(self.slots), self.channels) + tuple(image.shape[1:]),
+                                  dtype=torch.uint8).share_memory_()
+        self.labels = torch.zeros((len(self.slots),) + tuple(label.shape)).share_memory_()
+        self.cached = torch.zeros(len(self.slots), dtype=torch.bool).share_memory_()
+        if first in self.slots:
+            self.images[0] = image[:self.channels]
+            self.labels[0] = label
+            self.cached[0] = True
+        self.mean = torch.tensor(mean).view(-1, 1, 1)
+        self.std = torch.tensor(std).view(-1, 1, 1)
+        print('Caching %d evaluation images (%.1f MB)' % (len(self.slots), self.images.numel() / 1024 ** 2))
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        slot = self.slots.get(idx)
+        if slot is None:
+            image, label = self.dataset[idx]
+        elif self.cached[slot]:
+            image, label = self.images[slot], self.labels[slot]
+        else:
+            image, label = self.dataset[idx]
+            self.images[slot] = image[:self.channels]
+            self.labels[slot] = label
+            self.cached[slot] = True
+        image = image.expand(3, -1, -1).float().div(255)
+        return (image - self.mean) / self.std, label
+
 if __name__ == '__main__':
 
     concat_datasets = []
@@ -0,0 +1,104 @@
+# --------------------------------------------------------
+# Evaluation metrics for multi-label classification
+# --------------------------------------------------------
+
+import torch
+import torch.distributed as dist
+
+import util.misc as misc
+
+
+def average_ranks(scores):
+    """
+    Rank (1-based) of every entry of scores [N, C] within its column, ties get the
+    average of the ranks they span. All columns are ranked in one pass.
+    """
+    n, num_classes = scores.shape
+    order = scores.argsort(dim=0)
+    sorted_scores = scores.gather(0, order)
+
+    # a run of ties starts wherever the sorted score changes
+    new_run = torch.ones_like(sorted_scores, dtype=torch.bool)
+    new_run[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    run_id = new_run.long().cumsum(dim=0) - 1
+    run_id = (run_id + torch.arange(num_classes, device=scores.device) * n).flatten()
+
+    positions = torch.arange(1, n + 1, dtype=torch.float64, device=scores.device)
+    positions = positions.unsqueeze(1).expand(n, num_classes).flatten()
+    run_sum = torch.zeros(n * num_classes, dtype=torch.float64, device=scores.device).scatter_add_(
+        0, run_id, positions)
+    run_count = torch.zeros_like(run_sum).scatter_add_(0, run_id, torch.ones_like(positions))
+    sorted_ranks = (run_sum / run_count.clamp(min=1))[run_id].view(n, num_classes)
+
+    return torch.empty_like(sorted_ranks).scatter_(0, order, sorted_ranks)
+
+
+def multilabel_auroc(targets, scores):
+    """
+    Exact AUROC of every class (Mann-Whitney U statistic) for targets and scores of
+    shape [N, C]. Classes with only positive or only negative samples get nan.
+    """
+    targets = torch.as_tensor(targets) > 0
+    scores = torch.as_tensor(scores, device=targets.device).to(torch.float64)
+    ranks = average_ranks(scores)
+
+    n_pos = targets.sum(dim=0).to(torch.float64)
+    n_neg = targets.shape[0] - n_pos
+    rank_sum = (ranks * targets).sum(dim=0)
+    auc = (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+    return torch.where((n_pos > 0) & (n_neg > 0), auc, torch.full_like(auc, float('nan')))
+
+
+class StreamingAUROC(object):
+    """Bounded-memory multi-label AUROC from per-class fixed-bin score histograms.
+
+    Memory is O(num_classes * num_bins) whatever the number of samples. Scores that
+    fall into the same bin are counted as ties, so the result is within error_bound()
+    of the exact AUROC (half the fraction of positive/negative pairs sharing a bin).
+    Scores are expected in [0, 1], i.e. after the sigmoid.
+    """
+
+    def __init__(self, num_classes, num_bins=10000, device='cpu'):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        # [negatives, positives] x classes x bins
+        self.hist = torch.zeros(2, num_classes, num_bins, dtype=torch.float64, device=device)
+        self._offsets = torch.arange(num_classes, device=device) * num_bins
+
+    def update(self, targets, scores):
+        bins = (scores.detach().float().clamp(0, 1) * self.num_bins).long().clamp(max=self.num_bins - 1)
+        labels = (targets[:, :self.num_classes] > 0).long()
+        index = labels * self.num_classes * self.num_bins + self._offsets + bins[:, :self.num_classes]
+        self.hist.view(-1).index_add_(0, index.flatten().to(self.hist.device),
+                                      torch.ones(index.numel(), dtype=self.hist.dtype, device=self.hist.device))
+
+    def synchronize_between_processes(self):
+        """
+        Merge the histograms of all processes with a single all-reduce.
+        """
+        if not misc.is_dist_avail_and_initialized():
+            return
+        hist = self.hist.to(misc.get_dist_device())
+        dist.all_reduce(hist)
+        self.hist = hist.to(self.hist.device)
+
+    def _pairs(self):
+        neg, pos = self.hist[0], self.hist[1]
+        return neg, pos, pos.sum(dim=-1) * neg.sum(dim=-1)
+
+    def compute(self):
+        """
+        AUROC of every class, nan for classes that have only seen one label so far.
+        """
+        neg, pos, num_pairs = self._pairs()
+        neg_below = neg.cumsum(dim=-1) - neg
+        auc = (pos * (neg_below + 0.5 * neg)).sum(dim=-1) / num_pairs
+        return torch.where(num_pairs > 0, auc, torch.full_like(auc, float('nan')))
+
+    def error_bound(self):
+        """
+        Largest absolute difference to the exact AUROC over all classes.
+        """
+        neg, pos, num_pairs = self._pairs()
+        bound = 0.5 * (pos * neg).sum(dim=-1) / num_pairs.clamp(min=1)
+        return bound.max().item()
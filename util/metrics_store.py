@@ -0,0 +1,184 @@
+# --------------------------------------------------------
+# Columnar store of the JSON-lines metrics (log.txt) written by main_distill.py and
+# main_med_finetune.py. Each run is one .npz of float64 columns, and index.json records
+# how far each log has been parsed, so re-ingesting only parses the appended lines.
+# --------------------------------------------------------
+
+import fnmatch
+import glob
+import io
+import json
+import math
+import numbers
+import os
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+
+
+def run_name(path, root=None):
+    """
+    Run key of a log file: its path relative to root (default: the working directory)
+    without the .txt extension, and without a trailing /log for output_dir/log.txt.
+    """
+    name = os.path.relpath(path, root or os.getcwd())
+    if name.endswith('.txt'):
+        name = name[:-len('.txt')]
+    if name.endswith(os.sep + 'log'):
+        name = name[:-len(os.sep + 'log')]
+    return name.replace(os.sep, '/')
+
+
+def flatten_record(record):
+    """
+    Numeric fields of one log line; lists (e.g. test_auc_each_class) become key.0, key.1, ...
+    Other values are dropped.
+    """
+    row = {}
+    for k, v in record.items():
+        if isinstance(v, (list, tuple)):
+            for i, item in enumerate(v):
+                if isinstance(item, numbers.Number):
+                    row['%s.%d' % (k, i)] = float(item)
+        elif isinstance(v, numbers.Number):
+            row[k] = float(v)
+    return row
+
+
+def _column_order(column):
+    # key.2 before key.10
+    name, _, suffix = column.rpartition('.')
+    return (name, int(suffix)) if name and suffix.isdigit() else (column, -1)
+
+
+def _write_atomic(path, write_fn):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write_fn(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class MetricsStore(object):
+    """
+    ingest() / ingest_glob() parse new log lines into the store; runs(), columns() and
+    load() read it. load() only decompresses the requested columns.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        index_path = os.path.join(root, INDEX_FILE)
+        self.index = {}
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def _run_path(self, run):
+        return os.path.join(self.root, run.replace('/', '__') + '.npz')
+
+    def _save_index(self):
+        _write_atomic(os.path.join(self.root, INDEX_FILE),
+                      lambda f: f.write(json.dumps(self.index, indent=1, sort_keys=True).encode('utf-8')))
+
+    def _read_run(self, run):
+        if run not in self.index:
+            return {}
+        with np.load(self._run_path(run)) as data:
+            return {k: data[k] for k in data.files}
+
+    def ingest(self, path, run=None, save_index=True):
+        """
+        Parse the lines appended to path since the last ingest. Returns the number of new rows.
+        A log that shrank (rewritten from scratch) is parsed again from the start;
+        an unterminated last line is left for the next ingest.
+        """
+        run = run or run_name(path)
+        entry = self.index.get(run)
+        size = os.path.getsize(path)
+        offset = 0
+        if entry is not None and entry['source'] == os.path.abspath(path) and entry['offset'] <= size:
+            offset = entry['offset']
+        if entry is not None and offset == entry['offset'] == size:
+            return 0
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        rows, skipped = [], 0
+        for line in data[:end].splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped += 1
+                continue
+            if isinstance(record, dict):
+                rows.append(flatten_record(record))
+            else:
+                skipped += 1
+
+        columns = self._read_run(run) if offset > 0 else {}
+        num_old = len(next(iter(columns.values()))) if columns else 0
+        keys = list(columns) + sorted({k for row in rows for k in row} - set(columns), key=_column_order)
+        new_columns = {}
+        for k in keys:
+            new = np.array([row.get(k, math.nan) for row in rows], dtype=np.float64)
+            old = columns[k] if k in columns else np.full(num_old, math.nan)
+            new_columns[k] = np.concatenate([old, new])
+
+        def write(f):
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, **new_columns)
+            f.write(buffer.getvalue())
+        _write_atomic(self._run_path(run), write)
+        if offset > 0:
+            skipped += entry['skipped']
+        self.index[run] = {'source': os.path.abspath(path), 'offset': offset + end, 'rows': num_old + len(rows),
+                           'skipped': skipped}
+        if save_index:
+            self._save_index()
+        return len(rows)
+
+    def ingest_glob(self, patterns, root=None):
+        """
+        Ingest every file matching the glob patterns; runs are named relative to root.
+        Returns {run: new rows}.
+        """
+        new_rows = {}
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    run = run_name(path, root)
+                    new_rows[run] = self.ingest(path, run=run, save_index=False)
+        self._save_index()
+        return new_rows
+
+    def runs(self, pattern='*'):
+        return sorted(run for run in self.index if fnmatch.fnmatch(run, pattern))
+
+    def columns(self, run):
+        with np.load(self._run_path(run)) as data:
+            return list(data.files)
+
+    def load(self, run, columns):
+        """
+        {column: float64 array} of one run; columns it does not have are all NaN.
+        A column name ending in '.*' selects all the entries of a flattened list.
+        """
+        out = {}
+        with np.load(self._run_path(run)) as data:
+            num_rows = self.index[run]['rows']
+            for column in columns:
+                if column.endswith('.*'):
+                    for k in data.files:
+                        if fnmatch.fnmatch(k, column):
+                            out[k] = data[k]
+                else:
+                    out[column] = data[column] if column in data.files else np.full(num_rows, math.nan)
+        return out
@@ -10,20 +10,32 @@
 # --------------------------------------------------------
 
 import builtins
+import contextlib
 import datetime
+import math
 import os
+import queue
+import random
+import sys
+import threading
 import time
 from collections import defaultdict, deque
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch import inf
+from torch.distributed.optim import ZeroRedundancyOptimizer
 
 
 class SmoothedValue(object):
     """Track a series of values and provide access to smoothed values over a
     window or the global series average.
+
+    Values may be python numbers or (0-dim) tensors. Tensors are kept on their
+    device and only copied to the host when a statistic is read, so updating a
+    meter never forces a device synchronization.
     """
 
     def __init__(self, window_size=20, fmt=None):
@@ -33,11 +45,48 @@ class SmoothedValue(object):
         self.total = 0.0
         self.count = 0
         self.fmt = fmt
+        self._device_total = None
 
     def update(self, value, n=1):
+        if isinstance(value, torch.Tensor):
+            value = value.detach().reshape(()).to(torch.float64)
+            if self._device_total is None:
+                self._device_total = value * n
+            else:
+                self._device_total = self._device_total + value * n
+        else:
+            self.total += value * n
         self.deque.append(value)
         self.count += n
-        self.total += value * n
+
+    def pending(self):
+        """
+        Device-side values that have not been copied to the host yet.
+        """
+        pending = [v for v in self.deque if isinstance(v, torch.Tensor)]
+        if self._device_total is not None:
+            pending.append(self._device_total)
+        return pending
+
+    def resolve(self, values):
+        """
+        Replace the pending tensors (in the order returned by pending()) with the
+        host values in `values`, and return the values that were not consumed.
+        """
+        values = list(values)
+        resolved = deque(maxlen=self.deque.maxlen)
+        for v in self.deque:
+            resolved.append(values.pop(0) if isinstance(v, torch.Tensor) else v)
+        self.deque = resolved
+        if self._device_total is not None:
+            self.total += values.pop(0)
+            self._device_total = None
+        return values
+
+    def materialize(self):
+        pending = self.pending()
+        if pending:
+            self.resolve(torch.stack(pending).tolist())
 
     def synchronize_between_processes(self):
         """
@@ -45,7 +94,8 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        self.materialize()
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device=get_dist_device())
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -54,24 +104,29 @@ class SmoothedValue(object):
 
     @property
     def median(self):
+        self.materialize()
         d = torch.tensor(list(self.deque))
         return d.median().item()
 
     @property
     def avg(self):
+        self.materialize()
         d = torch.tensor(list(self.deque), dtype=torch.float32)
         return d.mean().item()
 
     @property
     def global_avg(self):
+        self.materialize()
         return self.total / self.count
 
     @property
     def max(self):
+        self.materialize()
         return max(self.deque)
 
     @property
     def value(self):
+        self.materialize()
         return self.deque[-1]
 
     def __str__(self):
@@ -87,14 +142,14 @@ class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
         self.delimiter = delimiter
+        self.finite_meters = []
 
     def update(self, **kwargs):
         for k, v in kwargs.items():
             if v is None:
                 continue
-            if isinstance(v, torch.Tensor):
-                v = v.item()
-            assert isinstance(v, (float, int))
+            if not isinstance(v, torch.Tensor):
+                assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
     def __getattr__(self, attr):
@@ -106,6 +161,7 @@ class MetricLogger(object):
             type(self).__name__, attr))
 
     def __str__(self):
+        self.materialize()
         loss_str = []
         for name, meter in self.meters.items():
             loss_str.append(
@@ -113,9 +169,44 @@ class MetricLogger(object):
             )
         return self.delimiter.join(loss_str)
 
+    def materialize(self):
+        """
+        Copy the pending device-side values of every meter to the host in one transfer.
+        """
+        meters = [m for m in self.meters.values() if m.pending()]
+        if not meters:
+            return
+        pending = [t for m in meters for t in m.pending()]
+        device = pending[0].device
+        values = torch.stack([t.to(device) for t in pending]).tolist()
+        for meter in meters:
+            values = meter.resolve(values)
+
+    def require_finite(self, *names):
+        """
+        Stop training if any of the named meters sees a non-finite value. The check
+        is done lazily on the running totals whenever the logger prints.
+        """
+        self.finite_meters.extend(names)
+
+    def check_finite(self):
+        self.materialize()
+        for name in self.finite_meters:
+            if name in self.meters and not math.isfinite(self.meters[name].global_avg):
+                print("Loss is {}, stopping training".format(self.meters[name].value))
+                sys.exit(1)
+
     def synchronize_between_processes(self):
-        for meter in self.meters.values():
-            meter.synchronize_between_processes()
+        if not is_dist_avail_and_initialized():
+            return
+        self.materialize()
+        # pack (count, total) of every meter into a single all-reduce
+        meters = list(self.meters.values())
+        t = torch.tensor([[m.count, m.total] for m in meters], dtype=torch.float64, device=get_dist_device())
+        dist.all_reduce(t)
+        for meter, (count, total) in zip(meters, t.tolist()):
+            meter.count = int(count)
+            meter.total = total
 
     def add_meter(self, name, meter):
         self.meters[name] = meter
@@ -146,6 +237,7 @@ class MetricLogger(object):
             yield obj
             iter_time.update(time.time() - end)
             if i % print_freq == 0 or i == len(iterable) - 1:
+                self.check_finite()
                 eta_seconds = iter_time.global_avg * (len(iterable) - i)
                 eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
                 if torch.cuda.is_available():
@@ -208,12 +300,57 @@ def is_main_process():
     return get_rank() == 0
 
 
-def save_on_master(*args, **kwargs):
+def save_on_master(obj, path):
     if is_main_process():
-        torch.save(*args, **kwargs)
+        atomic_save(obj, path)
+
+
+def atomic_save(obj, path):
+    """
+    torch.save to a temporary file next to path and rename it into place, so a reader
+    never sees a partially written checkpoint.
+    """
+    path = str(path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def get_dist_device():
+    """
+    Device that collective tensors have to live on for the current process group.
+    """
+    if is_dist_avail_and_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
+def setup_cpu_threads(local_rank, local_world_size, num_threads=0):
+    """
+    Split the cores available to this node evenly between its local processes: each
+    process is pinned to its own block of cores and sizes its intra-op thread pool
+    (OMP_NUM_THREADS) to it. num_threads > 0 overrides the per-process thread count.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    cores_per_proc = max(len(cores) // local_world_size, 1)
+    local_cores = cores[local_rank * cores_per_proc:(local_rank + 1) * cores_per_proc] or cores
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, local_cores)
+    if num_threads <= 0:
+        num_threads = len(local_cores)
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    return local_cores
 
 
 def init_distributed_mode(args):
+    use_cuda = torch.device(args.device).type == 'cuda'
     if args.dist_on_itp:
         args.rank = int(os.environ['OMPI_COMM_WORLD_RANK'])
         args.world_size = int(os.environ['OMPI_COMM_WORLD_SIZE'])
@@ -229,17 +366,30 @@ def init_distributed_mode(args):
         args.gpu = int(os.environ['LOCAL_RANK'])
     elif 'SLURM_PROCID' in os.environ:
         args.rank = int(os.environ['SLURM_PROCID'])
-        args.gpu = args.rank % torch.cuda.device_count()
+        if use_cuda:
+            args.gpu = args.rank % torch.cuda.device_count()
+        else:
+            args.gpu = int(os.environ.get('SLURM_LOCALID', 0))
     else:
         print('Not using distributed mode')
         setup_for_distributed(is_master=True)  # hack
         args.distributed = False
+        if not use_cuda:
+            setup_cpu_threads(0, 1, getattr(args, 'cpu_threads', 0))
         return
 
     args.distributed = True
 
-    torch.cuda.set_device(args.gpu)
-    args.dist_backend = 'nccl'
+    if use_cuda:
+        torch.cuda.set_device(args.gpu)
+        args.dist_backend = 'nccl'
+    else:
+        # args.gpu is the local rank here, it is used to pick this process' block of cores
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))
+        local_cores = setup_cpu_threads(args.gpu, local_world_size, getattr(args, 'cpu_threads', 0))
+        print('| cpu threads (rank {}): {} on cores {}-{}'.format(
+            args.rank, torch.get_num_threads(), local_cores[0], local_cores[-1]), flush=True)
+        args.dist_backend = 'gloo'
     print('| distributed init (rank {}): {}, gpu {}'.format(
         args.rank, args.dist_url, args.gpu), flush=True)
     torch.distributed.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
@@ -248,22 +398,50 @@ def init_distributed_mode(args):
     setup_for_distributed(args.rank == 0)
 
 
+def autocast(device, precision='fp16'):
+    """
+    Autocast context for the device type of `device` and the given precision (fp32, fp16 or bf16).
+    fp16 autocast is only used on CUDA, elsewhere fp16 runs in fp32 as it did before.
+    """
+    device_type = torch.device(device).type
+    if precision == 'bf16':
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    if precision == 'fp16' and device_type == 'cuda':
+        return torch.autocast(device_type='cuda', dtype=torch.float16)
+    return contextlib.nullcontext()
+
+
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        # loss scaling is only needed for fp16 on CUDA, a disabled scaler is a plain backward/step
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled and torch.cuda.is_available())
+
+    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True,
+                 compute_norm=False):
+        """
+        The gradient norm is only computed when clipping or when compute_norm is set,
+        otherwise None is returned and the scaler unscales inside step().
+        """
+        self.backward(loss, create_graph=create_graph)
+        return self.step(optimizer, clip_grad=clip_grad, parameters=parameters, update_grad=update_grad,
+                         compute_norm=compute_norm)
 
-    def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
+    def backward(self, loss, create_graph=False):
         self._scaler.scale(loss).backward(create_graph=create_graph)
+
+    def step(self, optimizer, clip_grad=None, parameters=None, update_grad=True, compute_norm=False):
         if update_grad:
             if clip_grad is not None:
                 assert parameters is not None
                 self._scaler.unscale_(optimizer)  # unscale the gradients of optimizer's assigned params in-place
-                norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad)
-            else:
+                norm = torch.nn.utils.clip_grad_norm_(parameters, clip_grad, foreach=True)
+            elif compute_norm:
                 self._scaler.unscale_(optimizer)
                 norm = get_grad_norm_(parameters)
+            else:
+                norm = None
             self._scaler.step(optimizer)
             self._scaler.update()
         else:
@@ -280,20 +458,190 @@ class NativeScalerWithGradNormCount:
 def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
-    parameters = [p for p in parameters if p.grad is not None]
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
     norm_type = float(norm_type)
-    if len(parameters) == 0:
+    if len(grads) == 0:
         return torch.tensor(0.)
-    device = parameters[0].grad.device
+    device = grads[0].device
     if norm_type == inf:
-        total_norm = max(p.grad.detach().abs().max().to(device) for p in parameters)
+        total_norm = max(g.abs().max().to(device) for g in grads)
     else:
-        total_norm = torch.norm(torch.stack([torch.norm(p.grad.detach(), norm_type).to(device) for p in parameters]),
-                                norm_type)
+        # one multi-tensor kernel for all per-parameter norms
+        norms = torch._foreach_norm(grads, norm_type)
+        total_norm = torch.norm(torch.stack([n.to(device) for n in norms]), norm_type)
     return total_norm
 
 
-def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
+def create_adamw(param_groups, args, **kwargs):
+    """
+    AdamW using the implementation in args.opt_impl ('fused', 'foreach' or 'default').
+    Fused AdamW is not available on every device, in which case foreach is used.
+    Layer-wise lr decay is unaffected, lr_sched still sets the lr of every group.
+
+    With args.shard_optimizer in distributed mode, the AdamW states are sharded across the
+    processes (ZeRO stage 1, ZeroRedundancyOptimizer): each process keeps the states of its
+    share of the parameters of every group, updates them and broadcasts them to the others.
+    Its param_groups still hold all parameters, so lr_sched works as is; save_model and
+    StepCheckpointer consolidate the states on the main process (see optimizer_state_dict).
+
+    The optimizer writes its defaults (foreach, fused, ...) into the group dicts, so it gets
+    copies: the caller's groups can be reused for another optimizer.
+    """
+    opt_impl = getattr(args, 'opt_impl', 'default')
+    param_groups = [dict(g) if isinstance(g, dict) else g for g in param_groups]
+    sharded = getattr(args, 'shard_optimizer', False) and get_world_size() > 1
+    if sharded:
+        print('AdamW states sharded across %d processes' % get_world_size())
+
+    def adamw(param_groups, **impl_kwargs):
+        if sharded:
+            return ZeroRedundancyOptimizer(param_groups, optimizer_class=torch.optim.AdamW, lr=args.lr,
+                                           **impl_kwargs, **kwargs)
+        return torch.optim.AdamW(param_groups, lr=args.lr, **impl_kwargs, **kwargs)
+
+    if opt_impl == 'fused':
+        try:
+            # a failed attempt leaves fused=True in the group dicts it got, so try on copies
+            return adamw([dict(g) if isinstance(g, dict) else g for g in param_groups], fused=True)
+        except RuntimeError as e:
+            print('Fused AdamW not available ({}), using foreach'.format(e))
+            opt_impl = 'foreach'
+    if opt_impl == 'foreach':
+        return adamw(param_groups, foreach=True)
+    return adamw(param_groups)
+
+
+def optimizer_state_dict(optimizer):
+    """
+    The optimizer state_dict for a checkpoint. A sharded optimizer is first consolidated on
+    the main process, which every process must join; the others get None.
+    """
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        optimizer.consolidate_state_dict(to=0)
+        return optimizer.state_dict() if is_main_process() else None
+    return optimizer.state_dict()
+
+
+def snapshot_to_cpu(obj):
+    """
+    Copy the tensors of a (nested) state dict to the host: into pinned memory with non-blocking
+    copies for CUDA tensors, as clones otherwise, so training can keep updating the originals.
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cuda':
+            out = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            out.copy_(obj, non_blocking=True)
+            return out
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        out = type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointWriter:
+    """
+    Write checkpoints from a background thread. save() only snapshots the state to host memory;
+    serialization, the atomic rename and the retention policy run in the thread.
+
+    With keep_last_k > 0 only the last keep_last_k checkpoints written by this writer are kept,
+    plus the keep_best_k best ones by the metric given to set_metric(). When keep_best_k > 0,
+    or with keep_unscored (e.g. an asynchronous evaluator still has to load them), a checkpoint
+    that has not been scored yet is never removed. Files saved with retain=False
+    (e.g. checkpoint-last.pth) are not subject to retention.
+    """
+
+    def __init__(self, keep_last_k=0, keep_best_k=0, keep_unscored=False):
+        self.keep_last_k = keep_last_k
+        self.keep_best_k = keep_best_k
+        self.keep_unscored = keep_unscored or keep_best_k > 0
+        # at most one snapshot waits while another is written, which bounds the host memory
+        self.jobs = queue.Queue(maxsize=1)
+        self.lock = threading.Lock()
+        self.saved = []
+        self.metrics = {}
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, path, callback=None, retain=True):
+        """
+        Queue state for writing to path; callback(path) runs in the writer thread once the file is in place.
+        """
+        self._raise_error()
+        state = snapshot_to_cpu(state)
+        ready = None
+        if torch.cuda.is_available():
+            ready = torch.cuda.Event()
+            ready.record()
+        self.jobs.put((state, str(path), ready, callback, retain))
+
+    def set_metric(self, path, value):
+        with self.lock:
+            self.metrics[str(path)] = value
+            self._apply_retention()
+
+    def wait(self):
+        self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            state, path, ready, callback, retain = job
+            try:
+                if ready is not None:
+                    ready.synchronize()
+                atomic_save(state, path)
+                if retain:
+                    with self.lock:
+                        if path in self.saved:
+                            self.saved.remove(path)
+                        self.saved.append(path)
+                        self._apply_retention()
+                if callback is not None:
+                    callback(path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _apply_retention(self):
+        if self.keep_last_k <= 0:
+            return
+        keep = set(self.saved[-self.keep_last_k:])
+        if self.keep_best_k > 0:
+            scored = [p for p in self.saved if p in self.metrics]
+            keep.update(sorted(scored, key=self.metrics.get, reverse=True)[:self.keep_best_k])
+        if self.keep_unscored:
+            keep.update(p for p in self.saved if p not in self.metrics)
+        for path in [p for p in self.saved if p not in keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.saved.remove(path)
+            self.metrics.pop(path, None)
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint writer failed') from error
+
+
+def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, checkpoint_writer=None, on_saved=None):
     output_dir = Path(args.output_dir)
     epoch_name = str(epoch)
     if loss_scaler is not None:
@@ -301,16 +649,133 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
         for checkpoint_path in checkpoint_paths:
             to_save = {
                 'model': model_without_ddp.state_dict(),
-                'optimizer': optimizer.state_dict(),
+                'optimizer': optimizer_state_dict(optimizer),
                 'epoch': epoch,
                 'scaler': loss_scaler.state_dict(),
                 'args': args,
             }
 
-            save_on_master(to_save, checkpoint_path)
+            if checkpoint_writer is not None:
+                checkpoint_writer.save(to_save, checkpoint_path, callback=on_saved)
+            else:
+                save_on_master(to_save, checkpoint_path)
+                if on_saved is not None and is_main_process():
+                    on_saved(checkpoint_path)
+        return checkpoint_paths[0]
     else:
         client_state = {'epoch': epoch}
         model.save_checkpoint(save_dir=args.output_dir, tag="checkpoint-%s" % epoch_name, client_state=client_state)
+        return output_dir / ("checkpoint-%s" % epoch_name)
+
+
+def get_rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+
+class StepCheckpointer:
+    """
+    Writes output_dir/checkpoint-last.pth about every interval_minutes in the middle of an epoch,
+    with the number of iterations consumed in the epoch and the RNG states of all processes,
+    so that --resume continues from that iteration (see load_model).
+
+    The interval is turned into a number of iterations from the step time measured over the first
+    calibration_steps iterations of the run and broadcast from rank 0 once, so all processes save
+    at the same iteration without a collective per step. Iterations are counted across epochs, so
+    short epochs still checkpoint. Checkpoints are only taken at the end of a gradient accumulation
+    cycle, so no partial gradients have to be saved, and never on the last iteration of an epoch,
+    which would resume into an empty epoch.
+    """
+
+    def __init__(self, args, model_without_ddp, optimizer, loss_scaler, checkpoint_writer=None,
+                 calibration_steps=50):
+        self.args = args
+        self.model_without_ddp = model_without_ddp
+        self.optimizer = optimizer
+        self.loss_scaler = loss_scaler
+        self.checkpoint_writer = checkpoint_writer
+        self.calibration_steps = calibration_steps
+        self.path = Path(args.output_dir) / 'checkpoint-last.pth'
+        self.interval = None
+        # iterations (and their time, while calibrating) since the calibration or the last save
+        self.steps = 0
+        self.elapsed = 0.
+
+    def start_epoch(self, epoch, num_steps):
+        """num_steps: the index one past the last iteration of the epoch."""
+        self.epoch = epoch
+        self.num_steps = num_steps
+        self.last_time = time.time()
+
+    def step(self, data_iter_step):
+        """
+        Call after iteration data_iter_step (counted from the start of the epoch) is done.
+        """
+        consumed = data_iter_step + 1
+        self.steps += 1
+        if self.interval is None:
+            now = time.time()
+            self.elapsed += now - self.last_time
+            self.last_time = now
+            if self.steps == self.calibration_steps:
+                interval = max(1, int(self.args.ckpt_interval_minutes * 60 / (self.elapsed / self.steps)))
+                if is_dist_avail_and_initialized():
+                    interval = torch.tensor(interval, device=get_dist_device())
+                    dist.broadcast(interval, src=0)
+                    interval = int(interval.item())
+                self.interval = interval
+                self.steps = 0
+                print('Mid-epoch checkpoint every {} iterations'.format(self.interval))
+        elif (self.steps >= self.interval and consumed % self.args.accum_iter == 0
+              and consumed < self.num_steps):
+            self.save(consumed)
+            self.steps = 0
+
+    def save(self, consumed):
+        rng_states = [get_rng_state()]
+        if is_dist_avail_and_initialized():
+            rng_states = [None for _ in range(get_world_size())]
+            dist.all_gather_object(rng_states, get_rng_state())
+        optimizer_state = optimizer_state_dict(self.optimizer)
+        if not is_main_process():
+            return
+        to_save = {
+            'model': self.model_without_ddp.state_dict(),
+            'optimizer': optimizer_state,
+            'epoch': self.epoch,
+            'step': consumed,
+            'rng': rng_states,
+            'scaler': self.loss_scaler.state_dict(),
+            'args': self.args,
+        }
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(to_save, self.path, retain=False)
+        else:
+            atomic_save(to_save, self.path)
+
+
+def load_state_dict_file(path):
+    """
+    Model weights of a checkpoint: a safetensors file written by export_encoder.py, or the
+    'model' entry of a training checkpoint.
+    """
+    if str(path).endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path)
+    checkpoint = torch.load(path, map_location='cpu')
+    return checkpoint['model'] if 'model' in checkpoint else checkpoint
 
 
 def load_model(args, model_without_ddp, optimizer, loss_scaler):
@@ -328,6 +793,11 @@ def load_model(args, model_without_ddp, optimizer, loss_scaler):
         pass
 
     if args.resume:
+        if args.resume.endswith('.safetensors'):
+            # weights-only export (see export_encoder.py): nothing to resume but the model
+            model_without_ddp.load_state_dict(load_state_dict_file(args.resume))
+            print("Load weights %s" % args.resume)
+            return
         if args.resume.startswith('https'):
             checkpoint = torch.hub.load_state_dict_from_url(
                 args.resume, map_location='cpu', check_hash=True)
@@ -338,9 +808,18 @@ def load_model(args, model_without_ddp, optimizer, loss_scaler):
         if 'optimizer' in checkpoint and 'epoch' in checkpoint and not (hasattr(args, 'eval') and args.eval):
             optimizer.load_state_dict(checkpoint['optimizer'])
             args.start_epoch = checkpoint['epoch'] + 1
-            if 'scaler' in checkpoint:
+            if checkpoint.get('scaler'):
                 loss_scaler.load_state_dict(checkpoint['scaler'])
             print("With optim & sched!")
+            if 'step' in checkpoint:
+                # mid-epoch checkpoint of StepCheckpointer: continue within the epoch
+                args.start_epoch = checkpoint['epoch']
+                args.start_step = checkpoint['step']
+                if len(checkpoint['rng']) == get_world_size():
+                    set_rng_state(checkpoint['rng'][get_rank()])
+                else:
+                    print("Checkpoint was saved with %d processes, RNG states are not restored" % len(checkpoint['rng']))
+                print("Resume at iteration %d of epoch %d" % (args.start_step, args.start_epoch))
 
 
 def freeze_weights(args, model_without_ddp):
@@ -352,6 +831,23 @@ def freeze_weights(args, model_without_ddp):
                     print(k, ' is frozen!')
 
 
+def freeze_unused_parameters(model_without_ddp, loss_fn):
+    """
+    Run loss_fn(model_without_ddp).backward() once and freeze the trainable parameters that
+    get no gradient, so that DDP (static graph, no unused-parameter search) and the optimizer
+    only see the ones the loss uses. Returns their names.
+    """
+    loss_fn(model_without_ddp).backward()
+    unused = []
+    for k, v in model_without_ddp.named_parameters():
+        if v.requires_grad and v.grad is None:
+            v.requires_grad = False
+            unused.append(k)
+            print(k, ' is unused, frozen!')
+    model_without_ddp.zero_grad(set_to_none=True)
+    return unused
+
+
 def load_model_teacher(args, model_teacher_without_ddp):
     checkpoint = torch.load(args.teacher_model_path, map_location='cpu')
     model_teacher_without_ddp.load_state_dict(checkpoint['model'], strict=False)
@@ -361,9 +857,74 @@ def load_model_teacher(args, model_teacher_without_ddp):
 def all_reduce_mean(x):
     world_size = get_world_size()
     if world_size > 1:
-        x_reduce = torch.tensor(x).cuda()
+        x_reduce = torch.tensor(x, device=get_dist_device())
         dist.all_reduce(x_reduce)
         x_reduce /= world_size
         return x_reduce.item()
     else:
         return x
+
+
+def all_gather_sharded(x, total_size):
+    """
+    Gather the rows of x from all processes, where process r holds rows r, r + world_size, ...
+    of a [total_size, ...] result (see sampler.DistributedEvalSampler), with a single
+    all-gather. Shards are padded to equal length for the collective and the padding dropped.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return x
+    shard_size = math.ceil(total_size / world_size)
+    padded = x.new_zeros((shard_size,) + tuple(x.shape[1:]), device=get_dist_device())
+    padded[:x.shape[0]] = x
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    out = padded.new_empty((total_size,) + tuple(x.shape[1:]))
+    for rank, shard in enumerate(gathered):
+        out[rank::world_size] = shard[:len(range(rank, total_size, world_size))]
+    return out.to(x.device)
+
+
+class ScalarAccumulator(object):
+    """
+    Per-step scalar metrics summed on their device between log points, so that recording
+    them every step costs neither a device sync nor a collective. flush() returns their
+    means over the recorded steps and all processes, with a single all-reduce.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = defaultdict(int)
+
+    def update(self, metrics):
+        for k, v in metrics.items():
+            v = v.detach().reshape(()).to(torch.float64) if isinstance(v, torch.Tensor) else float(v)
+            self.sums[k] = self.sums[k] + v if k in self.sums else v
+            self.counts[k] += 1
+
+    def flush(self):
+        means = all_reduce_mean_dict({k: v / self.counts[k] for k, v in self.sums.items()})
+        self.sums = {}
+        self.counts = defaultdict(int)
+        return means
+
+
+def all_reduce_mean_dict(metrics):
+    """
+    Average a dict of scalars (python numbers or 0-dim tensors) over all processes
+    with a single all-reduce on one flattened tensor. Returns python floats.
+    """
+    if len(metrics) == 0:
+        return {}
+    tensors = [v for v in metrics.values() if isinstance(v, torch.Tensor)]
+    device = tensors[0].device if tensors else torch.device('cpu')
+    world_size = get_world_size()
+    if world_size > 1:
+        device = get_dist_device()
+    packed = torch.stack([v.detach().reshape(()).to(device, torch.float64) if isinstance(v, torch.Tensor)
+                          else torch.tensor(float(v), dtype=torch.float64, device=device)
+                          for v in metrics.values()])
+    if world_size > 1:
+        dist.all_reduce(packed)
+        packed /= world_size
+    return dict(zip(metrics.keys(), packed.tolist()))
@@ -0,0 +1,178 @@
+# --------------------------------------------------------
+# Opt-in step-phase timing, throughput and MFU accounting for the training engines
+# --------------------------------------------------------
+
+import contextlib
+import os
+import time
+from collections import defaultdict
+
+import torch
+
+import util.misc as misc
+
+# dense peak TFLOPS per device by (device name substring, precision), used when --peak_tflops is 0
+PEAK_TFLOPS = {
+    ('H100', 'bf16'): 989., ('H100', 'fp16'): 989., ('H100', 'fp32'): 67.,
+    ('A100', 'bf16'): 312., ('A100', 'fp16'): 312., ('A100', 'fp32'): 19.5,
+    ('V100', 'fp16'): 125., ('V100', 'fp32'): 15.7,
+    ('A10', 'bf16'): 125., ('A10', 'fp16'): 125., ('A10', 'fp32'): 31.2,
+    ('T4', 'fp16'): 65., ('T4', 'fp32'): 8.1,
+}
+
+
+def transformer_block_flops(num_tokens, dim, mlp_hidden_dim):
+    """Forward FLOPs of one pre-norm ViT block: qkv/proj/MLP matmuls and the two attention matmuls."""
+    return 2 * num_tokens * (4 * dim * dim + 2 * dim * mlp_hidden_dim) + 4 * num_tokens * num_tokens * dim
+
+
+def model_flops_per_image(model, mask_ratio=None):
+    """
+    Forward FLOPs per image of a models_vit.VisionTransformer (all tokens) or a
+    models_mae_distill.MaskedAutoencoderViT (encoder on the visible tokens, decoder on all),
+    from the configuration of the model. None for other architectures.
+    Norms, activations and the projection heads are not counted.
+    """
+    if not hasattr(model, 'blocks') or not hasattr(model, 'patch_embed'):
+        return None
+    dim = model.cls_token.shape[-1]
+    num_patches = model.patch_embed.num_patches
+    patch_dim = model.patch_embed.proj.weight[0].numel()
+    num_tokens = 1 + num_patches
+    if hasattr(model, 'decoder_blocks'):
+        num_tokens = 1 + int(num_patches * (1 - mask_ratio))
+
+    flops = 2 * num_patches * patch_dim * dim
+    flops += len(model.blocks) * transformer_block_flops(num_tokens, dim, model.blocks[0].mlp.fc1.out_features)
+    if hasattr(model, 'decoder_blocks'):
+        decoder_dim = model.decoder_embed.out_features
+        flops += 2 * num_tokens * dim * decoder_dim
+        flops += len(model.decoder_blocks) * transformer_block_flops(
+            1 + num_patches, decoder_dim, model.decoder_blocks[0].mlp.fc1.out_features)
+        flops += 2 * num_patches * decoder_dim * model.decoder_pred.out_features
+    elif hasattr(model, 'head') and isinstance(model.head, torch.nn.Linear):
+        flops += 2 * dim * model.head.out_features
+    return flops
+
+
+def tokens_per_image(model, mask_ratio=None):
+    """Encoder tokens per image (cls token included) of a ViT / MAE, None for other architectures."""
+    if not hasattr(model, 'patch_embed'):
+        return None
+    if hasattr(model, 'decoder_blocks'):
+        return 1 + int(model.patch_embed.num_patches * (1 - mask_ratio))
+    return 1 + model.patch_embed.num_patches
+
+
+def peak_tflops(args, device):
+    if args.peak_tflops > 0:
+        return args.peak_tflops
+    if device.type == 'cuda':
+        name = torch.cuda.get_device_name(device)
+        for (key, precision), tflops in PEAK_TFLOPS.items():
+            if key in name and precision == args.precision:
+                return tflops
+    return None
+
+
+class StepProfiler(object):
+    """
+    Per-phase wall time of the training steps (with --profile), and a torch.profiler trace of
+    --profile_trace_steps steps written to --log_dir (first epoch only).
+
+    The engines wrap each part of a step in phase(name) and call step() at its end. Phase
+    timings synchronize the device at the phase boundaries, so they are exact but slow the
+    step down a little; that is why profiling is opt-in. With profiling off every call is a no-op.
+    Throughput counts the images of all processes; MFU is per device, relative to
+    --peak_tflops (or a known peak for the GPU model), counting train_flops_per_image for
+    forward + backward (3x forward) and frozen_flops_per_image for forward-only models.
+    """
+
+    def __init__(self, args, device, epoch, train_flops_per_image=None, frozen_flops_per_image=0,
+                 tokens_per_image=None):
+        self.enabled = args.profile
+        self.device = device
+        self.phase_totals = defaultdict(float)
+        self.num_steps = 0
+        self.total_time = 0.
+        self.tokens_per_image = tokens_per_image
+        self.flops_per_image = None
+        if train_flops_per_image is not None:
+            self.flops_per_image = 3 * train_flops_per_image + frozen_flops_per_image
+        self.peak_tflops = peak_tflops(args, device)
+
+        self.trace = None
+        if args.profile_trace_steps > 0 and epoch == args.start_epoch and args.log_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            trace_dir = os.path.join(args.log_dir, 'trace')
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=args.profile_trace_wait, warmup=1,
+                                                 active=args.profile_trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    trace_dir, worker_name='rank%d' % misc.get_rank()),
+                record_shapes=True, profile_memory=True)
+            self.trace.start()
+            print('Writing a torch.profiler trace of %d steps to %s' % (args.profile_trace_steps, trace_dir))
+        self.step_start = time.perf_counter()
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled and self.trace is None:
+            yield
+            return
+        with torch.profiler.record_function(name):
+            if self.enabled:
+                self._synchronize()
+                start = time.perf_counter()
+            yield
+            if self.enabled:
+                self._synchronize()
+                self.phase_totals[name] += time.perf_counter() - start
+
+    def step(self, batch_size, metric_logger=None):
+        if self.trace is not None:
+            self.trace.step()
+        if not self.enabled:
+            return
+        self._synchronize()
+        now = time.perf_counter()
+        step_time = now - self.step_start
+        self.step_start = now
+        self.total_time += step_time
+        self.num_steps += 1
+        if metric_logger is not None:
+            images_per_s = batch_size * misc.get_world_size() / step_time
+            metric_logger.update(img_s=images_per_s)
+            if self.tokens_per_image is not None:
+                metric_logger.update(tok_s=images_per_s * self.tokens_per_image)
+            if self.flops_per_image is not None:
+                tflops = batch_size * self.flops_per_image / step_time / 1e12
+                metric_logger.update(tflops=tflops)
+                if self.peak_tflops is not None:
+                    metric_logger.update(mfu=tflops / self.peak_tflops)
+
+    def close(self, metric_logger=None):
+        """
+        Stop the trace and add the mean per-phase times (ms) to the logger. Returns them.
+        """
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+        if not self.enabled or self.num_steps == 0:
+            return {}
+        phases = {'time_' + k: v / self.num_steps * 1000. for k, v in self.phase_totals.items()}
+        # what no phase covers: waiting for the data loader, logging and the loop itself
+        phases['time_other'] = (self.total_time - sum(self.phase_totals.values())) / self.num_steps * 1000.
+        if metric_logger is not None:
+            for k, v in phases.items():
+                metric_logger.add_meter(k, misc.SmoothedValue(window_size=1, fmt='{value:.1f}'))
+                metric_logger.meters[k].update(v)
+        print('Step phases (ms): ' + '  '.join('{} {:.1f}'.format(k[len('time_'):], v) for k, v in phases.items()))
+        return phases
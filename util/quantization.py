@@ -0,0 +1,100 @@
+# --------------------------------------------------------
+# Int8 quantization of the linears of the transformer blocks of a frozen (teacher) model,
+# with torch.ao eager-mode quantization; CPU only.
+#
+# dynamic: int8 weights, activations quantized on the fly per batch; no calibration needed.
+# static:  int8 weights and activations with per-tensor scales fixed by a calibration pass.
+# Patch embed, norms, attention matmuls and the decoder embed / prediction stay in float.
+# --------------------------------------------------------
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import DeQuantStub, QuantStub
+
+# the nn.Linear layers of a timm Block
+BLOCK_LINEARS = ('attn.qkv', 'attn.proj', 'mlp.fc1', 'mlp.fc2')
+
+
+def block_linear_names(model):
+    """Names of the qkv / proj / fc1 / fc2 linears of the encoder and decoder blocks of model."""
+    names = []
+    for blocks_name in ('blocks', 'decoder_blocks'):
+        for i in range(len(getattr(model, blocks_name, []))):
+            names += ['%s.%d.%s' % (blocks_name, i, linear) for linear in BLOCK_LINEARS]
+    return names
+
+
+def quantized_engine():
+    """The quantized backend of this machine: x86 (fbgemm + onednn) when available."""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            return engine
+    raise RuntimeError('no quantized engine available, supported: %s' % engines)
+
+
+class StaticQuantLinear(nn.Module):
+    """
+    A float linear between a quantize and a dequantize stub, so that eager-mode static
+    quantization converts it to a quantized linear with fixed input and output scales.
+    """
+
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = QuantStub()
+        self.linear = linear
+        self.dequant = DeQuantStub()
+
+    @property
+    def in_features(self):
+        return self.linear.in_features
+
+    @property
+    def out_features(self):
+        return self.linear.out_features
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def _set_submodule(model, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name), child_name, module)
+
+
+def quantize_blocks(model, mode='dynamic', calibrate_fn=None):
+    """
+    Quantize the block linears of model in place, on the CPU, and return it.
+    For mode 'static', calibrate_fn(model) runs the calibration forwards with the
+    observers in place. The model is put in eval mode and marked with model.int8 = mode.
+    """
+    assert mode in ('dynamic', 'static'), mode
+    torch.backends.quantized.engine = quantized_engine()
+    qconfig = torch.ao.quantization.get_default_qconfig(torch.backends.quantized.engine)
+    names = block_linear_names(model)
+    model.cpu().eval()
+
+    if mode == 'dynamic':
+        torch.ao.quantization.quantize_dynamic(
+            model, {name: torch.ao.quantization.default_dynamic_qconfig for name in names},
+            dtype=torch.qint8, inplace=True)
+    else:
+        assert calibrate_fn is not None, 'static quantization needs calibration batches'
+        for name in names:
+            wrapper = StaticQuantLinear(model.get_submodule(name))
+            wrapper.qconfig = qconfig
+            _set_submodule(model, name, wrapper)
+        torch.ao.quantization.prepare(model, inplace=True)
+        with torch.no_grad():
+            calibrate_fn(model)
+        torch.ao.quantization.convert(model, inplace=True)
+    model.int8 = mode
+    return model
+
+
+def feature_drift(reference, x):
+    """Relative L2 error and mean token cosine similarity of x against reference ([N, L, D])."""
+    reference, x = reference.float(), x.float()
+    rel_error = ((x - reference).norm() / reference.norm().clamp_min(1e-12)).item()
+    cosine = torch.nn.functional.cosine_similarity(x, reference, dim=-1).mean().item()
+    return {'rel_l2': rel_error, 'cosine': cosine}
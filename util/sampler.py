@@ -34,6 +34,7 @@ class RASampler(torch.utils.data.Sampler):
         # self.num_selected_samples = int(math.ceil(len(self.dataset) / self.num_replicas))
         self.num_selected_samples = int(math.floor(len(self.dataset) // 256 * 256 / self.num_replicas))
         self.shuffle = shuffle
+        self.start_index = 0
 
     def __iter__(self):
         if self.shuffle:
@@ -55,10 +56,69 @@ class RASampler(torch.utils.data.Sampler):
         indices = indices[self.rank:self.total_size:self.num_replicas]
         assert len(indices) == self.num_samples
 
-        return iter(indices[:self.num_selected_samples])
+        return iter(indices[self.start_index:self.num_selected_samples])
 
     def __len__(self):
-        return self.num_selected_samples
+        return self.num_selected_samples - self.start_index
 
     def set_epoch(self, epoch):
-        self.epoch = epoch
\ No newline at end of file
+        self.epoch = epoch
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        # skip the samples of this epoch already consumed before a mid-epoch checkpoint
+        self.start_index = start_index
+
+
+class ResumableDistributedSampler(torch.utils.data.DistributedSampler):
+    """DistributedSampler that can start an epoch at an offset, so that training resumed
+    from a mid-epoch checkpoint skips the samples already consumed by this process without
+    loading them. The offset only applies until the next set_epoch.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+
+class DistributedEvalSampler(torch.utils.data.Sampler):
+    """Sampler that shards an evaluation set over processes without padding.
+    Process `rank` gets indices rank, rank + num_replicas, ... so every sample is
+    evaluated exactly once; use misc.all_gather_sharded to put the results back in
+    dataset order.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        if num_replicas is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            if not dist.is_available():
+                raise RuntimeError("Requires distributed package to be available")
+            rank = dist.get_rank()
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.total_size = len(self.dataset)
+        self.num_samples = len(range(self.rank, self.total_size, self.num_replicas))
+
+    def __iter__(self):
+        return iter(range(self.rank, self.total_size, self.num_replicas))
+
+    def __len__(self):
+        return self.num_samples